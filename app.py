@@ -3,6 +3,9 @@
 import os
 import io
 import json
+import hashlib
+import math
+import queue
 import time
 import traceback 
 import smtplib
@@ -10,9 +13,14 @@ from email.mime.text import MIMEText
 from email.header import Header
 from datetime import datetime
 from urllib.parse import urlsplit
-from threading import BoundedSemaphore
+from threading import BoundedSemaphore, Condition, Lock
+from collections import deque
+from contextlib import contextmanager
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, send_file
+# [NEW] 冷启动计时起点（第三方依赖导入之前），用于统计容器启动耗时
+MODULE_LOAD_STARTED = time.perf_counter()
+
+from flask import Flask, Blueprint, Response, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, send_file
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_wtf.csrf import CSRFProtect
@@ -21,90 +29,409 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
+import click
 import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from PIL import Image, ImageDraw
-import imagehash
-
+# 注意：selenium、PIL、imagehash、numpy 体积较大，统一在使用它们的函数内部按需导入
 
-# --- 1. 初始化应用、数据库和调度器 ---
-app = Flask(__name__)
 
-# 确保 instance 和 screenshots 文件夹存在
-if not os.path.exists('instance'): os.makedirs('instance')
-SCREENSHOT_DIR = "/app/screenshots"
-if not os.path.exists(SCREENSHOT_DIR): os.makedirs(SCREENSHOT_DIR)
-
-# 配置
-# 安全修复: 如果没有设置环境变量SECRET_KEY，则自动生成一个安全的随机字符，不再使用固定的弱前缀
-secret_key = os.environ.get('SECRET_KEY')
-if not secret_key:
-    secret_key = os.urandom(24).hex()
-    print("\n" + "="*60)
-    print("⚠️  [安全警告] 未设置 SECRET_KEY 环境变量！")
-    print("   系统已自动生成一个临时的随机密钥。每次重启此密钥都会改变，")
-    print("   这会导致重启后所有已登录的 Session 失效。")
-    print("   建议: 在部署环境设置固定且强随机的 SECRET_KEY 环境变量。")
-    print("="*60 + "\n")
-app.config['SECRET_KEY'] = secret_key
-
-# --- 全局安全配置 ---
-# 开启 SESSION_COOKIE_HTTPONLY 以防 XSS 窃取 Cookie
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-# 开启 SameSite 限制，减少 CSRF 和跨站跟踪风险
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-# 如果明确配置了 HTTPS，可以开启 SECURE (如果是反向代理且未配置信任头，开启可能导致 session 丢失)
-if os.environ.get('REQUIRE_HTTPS', 'false').lower() == 'true':
-    app.config['SESSION_COOKIE_SECURE'] = True
-
-# --- CSRF 保护配置 ---
-csrf = CSRFProtect(app)
-
-# --- 频率限制 (Rate Limiting) 配置 ---
+# --- 1. 扩展与全局对象 ---
+# [MODIFIED] 采用应用工厂模式：扩展在这里创建但不绑定应用，由 create_app() 按进程角色初始化。
+# 导入本模块不再建表、不再启动调度器，selenium / PIL / imagehash / numpy 也改为在用到时才导入，
+# 这样 `flask init-db` 等 CLI 命令与测试导入都不必付出完整的启动成本。
+db = SQLAlchemy()
+csrf = CSRFProtect()
 limiter = Limiter(
     get_remote_address,
-    app=app,
     default_limits=["200 per day", "50 per hour"],
     storage_uri="memory://"
 )
+scheduler = BackgroundScheduler(daemon=True, timezone='Asia/Shanghai')
+# cli_group=None: 蓝图上注册的命令直接挂在顶层，保持 `flask init-db` 的用法不变
+main = Blueprint('main', __name__, cli_group=None)
 
-# --- 数据库配置（支持 SQLite 和 MariaDB/MySQL）---
-# 优先使用环境变量 DATABASE_URL，未设置则使用 SQLite
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-    print(f"[DB] 使用外部数据库: {database_url.split('@')[-1] if '@' in database_url else database_url}")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'monitoring.db')
-    print("[DB] 使用本地 SQLite 数据库")
+SCREENSHOT_DIR = "/app/screenshots"
 
 # [NEW] 根据是否使用外部数据库，决定截图存储方式
 # 外部数据库 -> 存储到数据库 BLOB；本地 SQLite -> 存储到文件系统
-USE_DB_SCREENSHOT = database_url is not None
-print(f"[截图存储] {'数据库模式' if USE_DB_SCREENSHOT else '文件系统模式'}")
+USE_DB_SCREENSHOT = os.environ.get('DATABASE_URL') is not None
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# --- [NEW] 进程角色 ---
+# web:       提供 HTTP 页面与接口
+# scheduler: 启动 APScheduler 并从数据库同步监控任务（调度任务在本进程执行，因此自动包含 worker）
+# worker:    允许在本进程内启动浏览器执行检查（含手动“立即运行”）
+# cli:       只初始化应用，不产生任何副作用（flask 命令默认使用）
+APP_ROLES = ('web', 'scheduler', 'worker', 'cli')
+active_roles = set()
+# create_app() 创建的应用实例，供调度线程等无请求上下文的地方推送应用上下文
+flask_app = None
 
-# [NEW] 解决云环境数据库连接断开问题 (MySQL server has gone away)
-# pool_pre_ping: 每次使用连接前检测是否存活，断开则自动重连
-# pool_recycle: 280秒主动刷新连接，避开云防火墙300秒杀连接的阈值
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,
-    'pool_recycle': 280,
-}
+# --- [NEW] 并发控制 ---
+# 限制同时运行的浏览器实例数量，防止内存耗尽。browser_semaphore 与 BrowserPool 共用同一个上限：
+# 启动时根据容器内存上限与单个浏览器的内存占用计算，运行中由 browser_autoscaler 按内存压力与排队情况调整。
+# 设置环境变量 MAX_CONCURRENT_BROWSERS 可固定上限并关闭自动调整。
+MAX_CONCURRENT_BROWSERS = int(os.environ.get('MAX_CONCURRENT_BROWSERS', 2))
+BROWSER_AUTOSCALE = ('MAX_CONCURRENT_BROWSERS' not in os.environ
+                     and os.environ.get('BROWSER_AUTOSCALE', 'true').lower() == 'true')
 
-db = SQLAlchemy(app)
-scheduler = BackgroundScheduler(daemon=True, timezone='Asia/Shanghai')
+class ConcurrencyLimit:
+    """上限可在运行中调整的计数信号量"""
 
-# --- [NEW] 并发控制 ---
-# 限制同时运行的浏览器实例数量，防止内存耗尽
-# 建议值: 1GB内存设为1-2, 2GB+内存可设为3-4
-MAX_CONCURRENT_BROWSERS = 2
-browser_semaphore = BoundedSemaphore(MAX_CONCURRENT_BROWSERS)
+    def __init__(self, limit):
+        self._cond = Condition()
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self.timeouts = 0  # 等待超时（检查被跳过）的累计次数
+
+    def acquire(self, blocking=True, timeout=None):
+        with self._cond:
+            self.waiting += 1
+            try:
+                acquired = self._cond.wait_for(lambda: self.in_use < self.limit, timeout if blocking else 0)
+            finally:
+                self.waiting -= 1
+            if not acquired:
+                self.timeouts += 1
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self.in_use <= 0:
+                raise ValueError("ConcurrencyLimit released too many times")
+            self.in_use -= 1
+            self._cond.notify()
+
+    def resize(self, limit):
+        """调整上限；调小时已借出的名额不受影响，归还后才生效"""
+        with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+
+browser_semaphore = ConcurrencyLimit(MAX_CONCURRENT_BROWSERS)
+# 检查任务等待空闲浏览器的最长时间（秒），超时则跳过本次检查
+BROWSER_WAIT_SECONDS = 10
+
+
+# --- [NEW] 浏览器进程生命周期管理 ---
+# driver.quit() 失败时 chromium / chromedriver 子进程会残留下来，长时间运行后耗尽容器内存。
+# 这里通过 /proc 跟踪每个浏览器的进程树：定期（以及启动时）回收孤儿进程，
+# 对超过内存上限的浏览器强制回收，并在收到 SIGTERM 时排空正在执行的检查后再退出。
+BROWSER_PROCESS_NAMES = ('chromedriver', 'chromium', 'chrome', 'headless_shell')
+# 单个浏览器（chromedriver + 全部子进程）的 RSS 上限，超过后不再复用
+BROWSER_RSS_LIMIT_MB = int(os.environ.get('BROWSER_RSS_LIMIT_MB', 1024))
+# [NEW] 单次检查的默认端到端时间预算（秒），目标未单独配置时使用
+CHECK_TIMEOUT_SECONDS = int(os.environ.get('CHECK_TIMEOUT_SECONDS', 180))
+# 收到 SIGTERM 后等待正在执行的检查结束的最长时间（秒），需小于 docker stop 的宽限期（默认 10 秒）
+BROWSER_DRAIN_TIMEOUT = int(os.environ.get('BROWSER_DRAIN_TIMEOUT', 8))
+# 本应用启动的浏览器都使用此目录下的独立配置目录（--user-data-dir），目录名以所属进程的 PID 开头。
+# 回收孤儿进程时只处理命令行中带有该标记的进程，不会误杀同一主机上其他来源的 Chrome
+BROWSER_PROFILE_ROOT = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'webpage-monitor-browsers')
+
+def read_process_table():
+    """
+    读取 /proc 下的进程信息
+
+    Returns:
+        dict: {pid: (ppid, 进程名, 状态, RSS 字节数)}；非 Linux 环境返回空字典
+    """
+    table = {}
+    if not os.path.isdir('/proc'):
+        return table
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue  # 进程已退出
+        # 格式: pid (comm) state ppid ... ，comm 中可能含空格或括号，以最后一个 ')' 为界
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        table[int(entry)] = (int(fields[1]), comm, fields[0], int(fields[21]) * page_size)
+    return table
+
+def is_browser_process(name):
+    return name.startswith(BROWSER_PROCESS_NAMES)
+
+def browser_profile_of(pid):
+    """进程命令行中引用的本应用浏览器配置目录名（如 '123-1a2b3c4d'），没有标记时返回 None"""
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            args = f.read().decode(errors='replace').split('\0')
+    except OSError:
+        return None
+    marker = BROWSER_PROFILE_ROOT + os.sep
+    for arg in args:
+        index = arg.find(marker)
+        if index >= 0:
+            return arg[index + len(marker):].split(os.sep)[0] or None
+    return None
+
+def profile_owner(profile):
+    """配置目录所属进程的 PID"""
+    try:
+        return int(profile.split('-')[0])
+    except ValueError:
+        return None
+
+def process_tree(root_pid, table):
+    """返回以 root_pid 为根的进程树中所有 PID（包含自身）"""
+    children = {}
+    for pid, (ppid, _, _, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        if pid in table:
+            tree.append(pid)
+            stack.extend(children.get(pid, []))
+    return tree
+
+class BrowserSupervisor:
+    """浏览器进程监管：PID 跟踪、孤儿回收、内存上限与优雅退出"""
+
+    def __init__(self, rss_limit_mb=BROWSER_RSS_LIMIT_MB):
+        self._tracked = {}  # chromedriver PID -> driver
+        self._profiles = {}  # 配置目录名 -> chromedriver PID（浏览器启动完成前为 None）
+        self._lock = Lock()
+        self._rss_limit = rss_limit_mb * 1024 * 1024
+        self.draining = False
+        self.reaped_total = 0
+        self.recycled_total = 0
+
+    @staticmethod
+    def driver_pid(driver):
+        """chromedriver 进程的 PID（Chrome 进程都是它的后代）"""
+        try:
+            return driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def new_profile(self):
+        """为即将启动的浏览器分配配置目录，启动前即登记，避免启动过程中被当作孤儿回收"""
+        import uuid
+
+        profile = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._profiles[profile] = None
+        return os.path.join(BROWSER_PROFILE_ROOT, profile)
+
+    def release_profile(self, path):
+        """注销并删除配置目录"""
+        import shutil
+
+        with self._lock:
+            self._profiles.pop(os.path.basename(path), None)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def register(self, driver, profile_path):
+        pid = self.driver_pid(driver)
+        with self._lock:
+            self._profiles[os.path.basename(profile_path)] = pid
+            if pid:
+                self._tracked[pid] = driver
+        if pid:
+            print(f"[Supervisor] 已跟踪浏览器进程 chromedriver PID={pid}")
+
+    def unregister(self, driver):
+        pid = self.driver_pid(driver)
+        with self._lock:
+            self._tracked.pop(pid, None)
+            profiles = [name for name, owner in self._profiles.items() if owner == pid and pid]
+        for name in profiles:
+            self.release_profile(os.path.join(BROWSER_PROFILE_ROOT, name))
+
+    def snapshot(self, driver):
+        """当前浏览器进程树的 PID 列表，用于 quit 之后核对残留"""
+        pid = self.driver_pid(driver)
+        return process_tree(pid, read_process_table()) if pid else []
+
+    def rss_bytes(self, driver, table=None):
+        """浏览器进程树的 RSS 总和（字节）"""
+        table = table if table is not None else read_process_table()
+        pid = self.driver_pid(driver)
+        return sum(table[p][3] for p in process_tree(pid, table)) if pid else 0
+
+    def rss_samples(self):
+        """每个被跟踪浏览器的进程树 RSS（字节），供自动调整并发时估算单个浏览器的内存占用"""
+        table = read_process_table()
+        with self._lock:
+            drivers = list(self._tracked.values())
+        return [rss for rss in (self.rss_bytes(d, table) for d in drivers) if rss]
+
+    def over_limit(self, driver):
+        rss = self.rss_bytes(driver)
+        if rss > self._rss_limit:
+            print(f"[Supervisor] 浏览器 RSS {rss // 2**20} MB 超过上限 {self._rss_limit // 2**20} MB，将回收该实例")
+            self.recycled_total += 1
+            return True
+        return False
+
+    def kill(self, pids, table=None):
+        """强制结束仍然存活的浏览器进程（按进程名核对，防止 PID 复用误杀）"""
+        import signal
+
+        table = table if table is not None else read_process_table()
+        killed = 0
+        for pid in pids:
+            if pid in table and is_browser_process(table[pid][1]):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    killed += 1
+                except (ProcessLookupError, PermissionError):
+                    pass
+        self.reap_zombies()
+        return killed
+
+    def reap_zombies(self, table=None):
+        """回收本进程已退出但尚未 wait 的浏览器子进程（如崩溃的 chromedriver）"""
+        table = table if table is not None else read_process_table()
+        me = os.getpid()
+        reaped = 0
+        for pid, (ppid, name, state, _) in table.items():
+            if ppid == me and state == 'Z' and is_browser_process(name):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        reaped += 1
+                except ChildProcessError:
+                    pass
+        return reaped
+
+    def reap_orphans(self):
+        """
+        回收孤儿浏览器进程（调用方需持有浏览器池的锁，见 BrowserPool.reap_orphans）
+
+        只处理带有本应用配置目录标记的浏览器进程（未带标记的子进程按最近的带标记祖先判断）：
+        配置目录未被登记，且所属进程是本进程或已经退出，即视为孤儿，连同其上层未被跟踪的 chromedriver 一起结束。
+        另外，本进程启动但未被跟踪的 chromedriver（浏览器崩溃或 quit 失败遗留）也会被回收。
+        """
+        table = read_process_table()
+        with self._lock:
+            tracked = set(self._tracked)
+            profiles = set(self._profiles)
+        me = os.getpid()
+        marks = {}
+
+        def mark_of(pid):
+            # 沿父进程链向上，取最近的带标记浏览器进程的配置目录
+            chain = []
+            while pid in table and is_browser_process(table[pid][1]):
+                if pid in marks:
+                    break
+                chain.append(pid)
+                profile = browser_profile_of(pid)
+                if profile:
+                    marks[pid] = profile
+                    break
+                pid = table[pid][0]
+            result = marks.get(pid)
+            for p in chain:
+                marks[p] = result
+            return result
+
+        orphans = set()
+        for pid, (ppid, name, state, _) in table.items():
+            # 僵尸进程已经退出，只需 wait，交给 reap_zombies 处理
+            if not is_browser_process(name) or state == 'Z' or pid in tracked:
+                continue
+            if name.startswith('chromedriver') and ppid == me:
+                orphans.add(pid)
+                continue
+            profile = mark_of(pid)
+            if profile is None or profile in profiles:
+                continue
+            owner = profile_owner(profile)
+            if owner != me and owner in table:
+                continue  # 属于其他仍在运行的进程（如另一个 Gunicorn worker）
+            orphans.add(pid)
+            parent = ppid
+            while parent in table and is_browser_process(table[parent][1]) and parent not in tracked:
+                orphans.add(parent)
+                parent = table[parent][0]
+        killed = self.kill(orphans, table) if orphans else 0
+        zombies = self.reap_zombies(table)
+        self._remove_stale_profiles(table, profiles)
+        if killed or zombies:
+            self.reaped_total += killed + zombies
+            print(f"[Supervisor] 已回收孤儿浏览器进程 {killed} 个，僵尸进程 {zombies} 个")
+        return killed + zombies
+
+    def _remove_stale_profiles(self, table, profiles):
+        """删除未登记且所属进程已退出（或就是本进程）的配置目录"""
+        import shutil
+
+        try:
+            names = os.listdir(BROWSER_PROFILE_ROOT)
+        except OSError:
+            return
+        me = os.getpid()
+        for name in names:
+            owner = profile_owner(name)
+            if name not in profiles and (owner == me or owner not in table):
+                shutil.rmtree(os.path.join(BROWSER_PROFILE_ROOT, name), ignore_errors=True)
+
+    def stats(self, pool):
+        """导出浏览器进程数量与内存占用"""
+        table = read_process_table()
+        with self._lock:
+            tracked = dict(self._tracked)
+        processes = [pid for pid, info in table.items() if is_browser_process(info[1])]
+        return {
+            'tracked_browsers': len(tracked),
+            'idle_browsers': pool.idle_count(),
+            'busy_browsers': pool.busy_count(),
+            'browser_processes': len(processes),
+            'browser_rss_mb': round(sum(table[p][3] for p in processes) / 2**20, 1),
+            'per_browser_rss_mb': {pid: round(self.rss_bytes(d, table) / 2**20, 1) for pid, d in tracked.items()},
+            'rss_limit_mb': self._rss_limit // 2**20,
+            'reaped_total': self.reaped_total,
+            'recycled_total': self.recycled_total,
+            'draining': self.draining,
+        }
+
+    def drain(self, pool, timeout=BROWSER_DRAIN_TIMEOUT):
+        """停止接收新的检查，等待进行中的检查结束后关闭全部浏览器"""
+        if self.draining:
+            return
+        self.draining = True
+        print(f"[Supervisor] 开始排空浏览器 (进行中: {pool.busy_count()}，最长等待 {timeout} 秒)...")
+        deadline = time.time() + timeout
+        while pool.busy_count() and time.time() < deadline:
+            time.sleep(0.5)
+        pool.shutdown()
+        pool.reap_orphans()
+
+    def install_signal_handlers(self, pool):
+        """注册 SIGTERM 处理（排空后交还给原处理器，如 Gunicorn 的优雅退出）与退出钩子"""
+        import atexit
+        import signal
+
+        atexit.register(self.drain, pool, 0)
+        try:
+            previous = signal.getsignal(signal.SIGTERM)
+        except ValueError:
+            return
+
+        def handle_sigterm(signum, frame):
+            print("[Supervisor] 收到 SIGTERM，正在优雅退出...")
+            self.drain(pool)
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                raise SystemExit(0)
+
+        try:
+            signal.signal(signal.SIGTERM, handle_sigterm)
+        except ValueError:
+            # 只有主线程可以注册信号处理器
+            print("[Supervisor] 非主线程，跳过 SIGTERM 处理器注册")
+
+# 全局浏览器进程监管实例
+browser_supervisor = BrowserSupervisor()
 
 
 # --- [NEW] 浏览器池 ---
@@ -112,14 +439,19 @@ browser_semaphore = BoundedSemaphore(MAX_CONCURRENT_BROWSERS)
 class BrowserPool:
     """全局浏览器池，复用 Chrome 实例以提升性能"""
     
-    def __init__(self, max_size=MAX_CONCURRENT_BROWSERS, idle_timeout=300):
+    def __init__(self, limit=browser_semaphore, idle_timeout=300, supervisor=browser_supervisor):
         self._pool = []  # 空闲浏览器列表
+        self._busy = set()  # 已借出的浏览器
         self._lock = BoundedSemaphore(1)  # 保护池操作的锁
-        self._max_size = max_size
+        self._limit = limit  # 与检查任务共用的并发上限，池中实例总数不超过它
         self._idle_timeout = idle_timeout  # 空闲超时秒数
+        self._supervisor = supervisor
     
     def _create_browser(self):
         """创建新的浏览器实例"""
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
         print("[BrowserPool] 正在创建新的 Chrome 实例...")
         chrome_options = Options()
         chrome_options.add_argument('--headless')
@@ -128,13 +460,34 @@ class BrowserPool:
         chrome_options.add_argument('--disable-dev-shm-usage')
         chrome_options.add_argument('--window-size=1920,1080')
         chrome_options.page_load_strategy = 'eager'
+        # [NEW] 独立的配置目录同时作为本应用浏览器进程的标记，供孤儿回收识别
+        profile = self._supervisor.new_profile()
+        chrome_options.add_argument(f'--user-data-dir={profile}')
         
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.set_page_load_timeout(600)
-        driver.set_script_timeout(600)
+        try:
+            driver = webdriver.Chrome(options=chrome_options)
+        except Exception:
+            self._supervisor.release_profile(profile)
+            raise
+        self._supervisor.register(driver, profile)
+        # 实际超时由每次检查的时间预算 (CheckBudget) 重新设置，这里只是兜底值
+        driver.set_page_load_timeout(CHECK_TIMEOUT_SECONDS)
+        driver.set_script_timeout(CHECK_TIMEOUT_SECONDS)
         print("[BrowserPool] Chrome 实例创建成功！")
         return driver
     
+    def _quit(self, driver):
+        """关闭浏览器实例，并强制结束 quit 之后仍残留的进程"""
+        pids = self._supervisor.snapshot(driver)
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"[BrowserPool] 关闭浏览器实例时出错: {e}")
+        killed = self._supervisor.kill(pids)
+        if killed:
+            print(f"[BrowserPool] quit 后仍有 {killed} 个浏览器进程残留，已强制结束")
+        self._supervisor.unregister(driver)
+    
     def _is_healthy(self, driver):
         """检查浏览器实例是否仍然可用"""
         try:
@@ -155,6 +508,12 @@ class BrowserPool:
         except Exception as e:
             print(f"[BrowserPool] 清理浏览器状态时出错: {e}")
     
+    def idle_count(self):
+        return len(self._pool)
+    
+    def busy_count(self):
+        return len(self._busy)
+    
     def acquire(self):
         """获取一个可用的浏览器实例"""
         self._lock.acquire()
@@ -163,15 +522,15 @@ class BrowserPool:
                 driver, last_used = self._pool.pop(0)
                 if self._is_healthy(driver):
                     print("[BrowserPool] 复用现有 Chrome 实例")
+                    self._busy.add(driver)
                     return driver
                 else:
                     # 实例不健康，关闭它
-                    try:
-                        driver.quit()
-                    except:
-                        pass
+                    self._quit(driver)
             # 池中没有可用实例，创建新的
-            return self._create_browser()
+            driver = self._create_browser()
+            self._busy.add(driver)
+            return driver
         finally:
             self._lock.release()
     
@@ -179,22 +538,31 @@ class BrowserPool:
         """归还浏览器实例到池中"""
         self._lock.acquire()
         try:
-            if len(self._pool) < self._max_size:
+            self._busy.discard(driver)
+            if self._supervisor.draining or self._supervisor.over_limit(driver):
+                self._quit(driver)
+            elif len(self._pool) + len(self._busy) < self._limit.limit:
                 self._cleanup_browser(driver)
                 self._pool.append((driver, time.time()))
                 print(f"[BrowserPool] 浏览器已归还池中 (当前池大小: {len(self._pool)})")
             else:
                 # 池已满，关闭这个实例
                 print("[BrowserPool] 池已满，关闭多余实例")
-                try:
-                    driver.quit()
-                except:
-                    pass
+                self._quit(driver)
+        finally:
+            self._lock.release()
+    
+    def discard(self, driver):
+        """销毁可能有问题的浏览器实例，不再归还池中"""
+        self._lock.acquire()
+        try:
+            self._busy.discard(driver)
+            self._quit(driver)
         finally:
             self._lock.release()
     
     def cleanup_idle(self):
-        """清理空闲超时的浏览器实例"""
+        """清理空闲超时或超出内存上限的浏览器实例"""
         self._lock.acquire()
         try:
             now = time.time()
@@ -202,28 +570,52 @@ class BrowserPool:
             for driver, last_used in self._pool:
                 if now - last_used > self._idle_timeout:
                     print(f"[BrowserPool] 关闭空闲超时的实例 (空闲 {int(now - last_used)} 秒)")
-                    try:
-                        driver.quit()
-                    except:
-                        pass
+                    self._quit(driver)
+                elif self._supervisor.over_limit(driver):
+                    self._quit(driver)
                 else:
                     active.append((driver, last_used))
             self._pool = active
             if active:
                 print(f"[BrowserPool] 清理完成，剩余 {len(active)} 个实例")
+            # 顺带回收 quit 失败或进程崩溃遗留的孤儿浏览器进程
+            self._supervisor.reap_orphans()
+        finally:
+            self._lock.release()
+    
+    def reap_orphans(self):
+        """在池锁内回收孤儿浏览器进程，不会与正在启动的浏览器（尚未登记）竞争"""
+        self._lock.acquire()
+        try:
+            return self._supervisor.reap_orphans()
+        finally:
+            self._lock.release()
+    
+    def trim(self):
+        """并发上限调小后，关闭超出上限的空闲实例以尽快释放内存"""
+        self._lock.acquire()
+        try:
+            closed = 0
+            while self._pool and len(self._pool) + len(self._busy) > self._limit.limit:
+                driver, _ = self._pool.pop()
+                self._quit(driver)
+                closed += 1
+            if closed:
+                print(f"[BrowserPool] 并发上限已调小，关闭 {closed} 个空闲实例")
+            return closed
         finally:
             self._lock.release()
     
     def shutdown(self):
-        """关闭池中所有浏览器"""
+        """关闭所有浏览器（包括仍被借出的实例）"""
         self._lock.acquire()
         try:
             for driver, _ in self._pool:
-                try:
-                    driver.quit()
-                except:
-                    pass
+                self._quit(driver)
+            for driver in list(self._busy):
+                self._quit(driver)
             self._pool = []
+            self._busy.clear()
             print("[BrowserPool] 所有浏览器实例已关闭")
         finally:
             self._lock.release()
@@ -231,6 +623,206 @@ class BrowserPool:
 # 全局浏览器池实例
 browser_pool = BrowserPool()
 
+# --- [NEW] 浏览器并发自动调整 ---
+# 启动时按“(容器内存上限 - 预留) / 单个浏览器占用”计算并发上限；之后定期检查：
+# - 内存压力（PSI avg10）过高或剩余内存不足半个浏览器时，上限减 1，并关闭多出的空闲实例；
+# - 有检查在排队或因繁忙被跳过、剩余内存足够再启动一个浏览器且压力较低时，上限加 1。
+# 单个浏览器的占用起初按 BROWSER_MEMORY_MB 估算，运行中用实测的进程树 RSS 修正。
+BROWSER_MEMORY_MB = int(os.environ.get('BROWSER_MEMORY_MB', 400))
+# 预留给 Web / 调度 / 图像处理进程的内存
+APP_MEMORY_RESERVE_MB = int(os.environ.get('APP_MEMORY_RESERVE_MB', 300))
+BROWSER_LIMIT_MAX = int(os.environ.get('BROWSER_LIMIT_MAX', 6))
+AUTOSCALE_INTERVAL_SECONDS = 30
+# 扩容后至少间隔这么久再次扩容，让新浏览器的内存占用先体现出来
+AUTOSCALE_GROW_COOLDOWN = 120
+# 内存压力阈值（最近 10 秒内有任务因等待内存而停顿的时间百分比）
+MEMORY_PRESSURE_HIGH = 10.0
+MEMORY_PRESSURE_LOW = 1.0
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def _read_key_values(path):
+    """读取 /proc/meminfo、memory.stat 这类“键 值”格式的文件"""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.replace(':', ' ').split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    values[parts[0]] = int(parts[1])
+    except OSError:
+        pass
+    return values
+
+def read_memory_pressure(path):
+    """PSI 文件中 some 行的 avg10；内核不支持时返回 None"""
+    line = _read_first_line(path)
+    if not line or not line.startswith('some'):
+        return None
+    for field in line.split()[1:]:
+        key, _, value = field.partition('=')
+        if key == 'avg10':
+            return float(value)
+    return None
+
+def read_memory_status():
+    """
+    读取容器（cgroup v2 / v1）与系统的内存状态
+
+    Returns:
+        dict: limit（容器内存上限与物理内存的较小值）、used（容器工作集，不含可回收的页缓存）、
+              available（可用内存，取容器余量与系统 MemAvailable 的较小值），单位字节；
+              pressure（内存压力 PSI avg10，不支持时为 None）
+    """
+    meminfo = _read_key_values('/proc/meminfo')
+    total = meminfo.get('MemTotal', 0) * 1024
+    available = meminfo.get('MemAvailable', 0) * 1024
+    limit, used = total, total - available
+    pressure_path = '/proc/pressure/memory'
+
+    if os.path.exists('/sys/fs/cgroup/memory.max'):
+        # cgroup v2
+        raw_limit = _read_first_line('/sys/fs/cgroup/memory.max')
+        current = _read_first_line('/sys/fs/cgroup/memory.current')
+        stat = _read_key_values('/sys/fs/cgroup/memory.stat')
+        if raw_limit and raw_limit.isdigit():
+            limit = min(limit, int(raw_limit))
+        if current and current.isdigit():
+            used = int(current) - stat.get('inactive_file', 0)
+        if os.path.exists('/sys/fs/cgroup/memory.pressure'):
+            pressure_path = '/sys/fs/cgroup/memory.pressure'
+    elif os.path.exists('/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        # cgroup v1：未设置上限时 limit_in_bytes 是一个接近 2^63 的数，取较小值后即为物理内存
+        raw_limit = _read_first_line('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+        usage = _read_first_line('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+        stat = _read_key_values('/sys/fs/cgroup/memory/memory.stat')
+        if raw_limit and raw_limit.isdigit():
+            limit = min(limit, int(raw_limit))
+        if usage and usage.isdigit():
+            used = int(usage) - stat.get('total_inactive_file', 0)
+
+    return {
+        'limit': limit,
+        'used': max(0, used),
+        'available': max(0, min(available, limit - used)),
+        'pressure': read_memory_pressure(pressure_path),
+    }
+
+class BrowserAutoscaler:
+    """按内存余量、内存压力与排队情况调整浏览器并发上限"""
+
+    def __init__(self, limit=browser_semaphore, pool=browser_pool, supervisor=browser_supervisor):
+        self._limit = limit
+        self._pool = pool
+        self._supervisor = supervisor
+        self.enabled = BROWSER_AUTOSCALE
+        self.browser_bytes = BROWSER_MEMORY_MB * 2**20  # 单个浏览器的内存占用（实测后更新）
+        self.measured = False
+        self._last_timeouts = 0
+        self._last_grow = 0.0
+        self._last_blocked = None
+        self.history = deque(maxlen=50)
+
+    def _log(self, old, new, reason, status):
+        pressure = '-' if status['pressure'] is None else f"{status['pressure']:.1f}"
+        print(f"[Autoscale] 并发上限 {old} -> {new}: {reason} "
+              f"(可用 {status['available'] // 2**20} MB / 上限 {status['limit'] // 2**20} MB, "
+              f"内存压力 {pressure}, 单个浏览器 {self.browser_bytes // 2**20} MB, "
+              f"进行中 {self._limit.in_use}, 排队 {self._limit.waiting})")
+        self.history.append({
+            'time': datetime.now().isoformat(timespec='seconds'), 'from': old, 'to': new, 'reason': reason,
+            'available_mb': status['available'] // 2**20, 'pressure': status['pressure'],
+        })
+
+    def _resize(self, new, reason, status):
+        old = self._limit.limit
+        self._log(old, new, reason, status)
+        if new != old:
+            self._limit.resize(new)
+            if new < old:
+                self._pool.trim()
+
+    def capacity(self, status):
+        """按内存上限计算可容纳的浏览器数"""
+        usable = status['limit'] - APP_MEMORY_RESERVE_MB * 2**20
+        return min(BROWSER_LIMIT_MAX, max(1, int(usable // self.browser_bytes)))
+
+    def measure(self):
+        """用正在运行的浏览器的进程树 RSS 修正单个浏览器的内存占用"""
+        samples = self._supervisor.rss_samples()
+        if not samples:
+            return
+        sample = sum(samples) / len(samples)
+        self.browser_bytes = int(sample if not self.measured else 0.7 * self.browser_bytes + 0.3 * sample)
+        self.measured = True
+
+    def initialize(self):
+        """启动时计算初始并发上限"""
+        status = read_memory_status()
+        if not self.enabled:
+            self._log(self._limit.limit, self._limit.limit, '自动调整已关闭，使用固定上限', status)
+            return
+        self._resize(self.capacity(status), '按容器内存计算初始值', status)
+
+    def tick(self):
+        """定期调整一次并发上限"""
+        if not self.enabled or self._supervisor.draining:
+            return
+        self.measure()
+        status = read_memory_status()
+        pressure = status['pressure']
+        current = self._limit.limit
+        # 排队：正在等待名额的检查，加上自上次调整以来因等待超时被跳过的检查
+        timeouts = self._limit.timeouts
+        backlog = self._limit.waiting + timeouts - self._last_timeouts
+        self._last_timeouts = timeouts
+        blocked = None
+
+        if pressure is not None and pressure >= MEMORY_PRESSURE_HIGH and current > 1:
+            self._resize(current - 1, f'内存压力过高 (>= {MEMORY_PRESSURE_HIGH})', status)
+        elif status['available'] < self.browser_bytes // 2 and current > 1:
+            self._resize(current - 1, '剩余内存不足半个浏览器', status)
+        elif backlog:
+            if current >= BROWSER_LIMIT_MAX:
+                blocked = f'已达上限 BROWSER_LIMIT_MAX={BROWSER_LIMIT_MAX}'
+            elif status['available'] < self.browser_bytes * 1.5:
+                blocked = '剩余内存不足以再启动一个浏览器'
+            elif pressure is not None and pressure > MEMORY_PRESSURE_LOW:
+                blocked = '内存压力未回落'
+            elif time.monotonic() - self._last_grow < AUTOSCALE_GROW_COOLDOWN:
+                blocked = '扩容冷却中'
+            if blocked is None:
+                self._last_grow = time.monotonic()
+                self._resize(current + 1, f'有 {backlog} 个检查排队或被跳过，内存充足', status)
+            elif blocked != self._last_blocked:
+                # 同一原因只记录一次，避免每个周期重复刷屏
+                self._log(current, current, f'有检查排队，但{blocked}，保持不变', status)
+        self._last_blocked = blocked
+
+    def stats(self):
+        status = read_memory_status()
+        return {
+            'enabled': self.enabled,
+            'limit': self._limit.limit,
+            'in_use': self._limit.in_use,
+            'waiting': self._limit.waiting,
+            'skipped_total': self._limit.timeouts,
+            'browser_mb': self.browser_bytes // 2**20,
+            'browser_mb_measured': self.measured,
+            'memory_limit_mb': status['limit'] // 2**20,
+            'memory_available_mb': status['available'] // 2**20,
+            'memory_pressure': status['pressure'],
+            'history': list(self.history),
+        }
+
+# 全局浏览器并发自动调整实例
+browser_autoscaler = BrowserAutoscaler()
+
 
 # --- 2. 数据库模型 ---
 class MonitorTarget(db.Model):
@@ -243,7 +835,8 @@ class MonitorTarget(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     screenshot_width = db.Column(db.Integer, default=1920)
     screenshot_max_height = db.Column(db.Integer, default=15000)
-    threshold = db.Column(db.Integer, default=5)
+    # [MODIFIED] 浮点数：ssim / pixel 引擎的阈值通常小于 1
+    threshold = db.Column(db.Float, default=5)
     crop_area = db.Column(db.String(200), default='[]')
     login_method = db.Column(db.String(50), default='none')
     cookies = db.Column(db.Text, nullable=True)
@@ -254,6 +847,16 @@ class MonitorTarget(db.Model):
     submit_button_selector = db.Column(db.String(255), nullable=True)
     last_checked = db.Column(db.DateTime)
     last_changed = db.Column(db.DateTime)
+    # [NEW] 单次检查的时间预算（秒），为空时使用 CHECK_TIMEOUT_SECONDS
+    check_timeout = db.Column(db.Integer, nullable=True)
+    # [NEW] 对比引擎，见 COMPARATORS；阈值的单位随引擎而定
+    compare_engine = db.Column(db.String(20), default='dhash')
+    # [NEW] 最近一次检查的结果: baseline / unchanged / changed / blank / timeout / error
+    last_status = db.Column(db.String(20), nullable=True)
+    # [NEW] 当前快照的截图方式 (stitch / window)，为空表示升级前保存的整窗截图
+    screenshot_capture_mode = db.Column(db.String(20), nullable=True)
+    # [NEW] 检查耗时（秒）的指数滑动平均，供容量规划估算浏览器占用时间
+    avg_check_seconds = db.Column(db.Float, nullable=True)
     @property
     def screenshot_filename(self): return f"target_{self.id}.png"
 
@@ -269,6 +872,8 @@ class NotificationSettings(db.Model):
     to_email = db.Column(db.String(200), default='')
     bark_url = db.Column(db.String(500), default='')
     pushplus_token = db.Column(db.String(200), default='')
+    # [NEW] 通知合并窗口（秒），0 表示检测到变化后立即发送
+    digest_window_seconds = db.Column(db.Integer, default=0)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -282,6 +887,8 @@ class Screenshot(db.Model):
     target_id = db.Column(db.Integer, db.ForeignKey('monitor_target.id'), nullable=False, unique=True)
     # 使用 LONGBLOB (MySQL/MariaDB) 以支持大文件，默认 BLOB 只有 64KB
     image_data = db.Column(db.LargeBinary(length=2**24), nullable=False)  # 16MB 上限
+    # [NEW] 仪表盘预览用的缩略图，检查时由图像处理进程一并生成
+    thumbnail_data = db.Column(db.LargeBinary, nullable=True)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
     target = db.relationship('MonitorTarget', backref=db.backref('screenshot', uselist=False, cascade='all, delete-orphan'))
@@ -290,40 +897,66 @@ class Screenshot(db.Model):
 # --- 3. 辅助函数 ---
 
 # [NEW] 截图存储辅助函数
-def save_screenshot(target_id, image):
-    """保存截图（根据配置自动选择存储方式）"""
+def save_screenshot(target_id, png, thumbnail=None):
+    """保存截图的 PNG 字节与缩略图（根据配置自动选择存储方式）"""
     if USE_DB_SCREENSHOT:
         # 存储到数据库
-        img_bytes = io.BytesIO()
-        image.save(img_bytes, format='PNG')
-        img_data = img_bytes.getvalue()
-        
         screenshot = Screenshot.query.filter_by(target_id=target_id).first()
         if screenshot:
-            screenshot.image_data = img_data
+            screenshot.image_data = png
+            screenshot.thumbnail_data = thumbnail
             screenshot.updated_at = datetime.now()
         else:
-            screenshot = Screenshot(target_id=target_id, image_data=img_data)
+            screenshot = Screenshot(target_id=target_id, image_data=png, thumbnail_data=thumbnail)
             db.session.add(screenshot)
         # 注意：不在这里 commit，由调用者统一管理事务
-        print(f"[截图] 已保存到数据库 (target_id={target_id}, size={len(img_data)} bytes)")
+        print(f"[截图] 已保存到数据库 (target_id={target_id}, size={len(png)} bytes)")
     else:
         # 存储到文件系统
         path = os.path.join(SCREENSHOT_DIR, f"target_{target_id}.png")
-        image.save(path)
+        with open(path, 'wb') as f:
+            f.write(png)
+        save_thumbnail(target_id, thumbnail)
         print(f"[截图] 已保存到文件: {path}")
 
+# [NEW] 缩略图存储：数据库模式存于 Screenshot.thumbnail_data，文件模式为 target_<id>_thumb.png。
+# 传入 None 表示清除（如监控区域修改后），下次访问时重新生成
+def save_thumbnail(target_id, thumbnail):
+    if USE_DB_SCREENSHOT:
+        screenshot = Screenshot.query.filter_by(target_id=target_id).first()
+        if screenshot:
+            screenshot.thumbnail_data = thumbnail
+        return
+    path = os.path.join(SCREENSHOT_DIR, f"target_{target_id}_thumb.png")
+    if thumbnail is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'wb') as f:
+        f.write(thumbnail)
+
+def load_thumbnail(target_id):
+    """加载缩略图的 PNG 字节，不存在时返回 None（数据库模式下不读取原图数据）"""
+    if USE_DB_SCREENSHOT:
+        return db.session.query(Screenshot.thumbnail_data).filter_by(target_id=target_id).scalar()
+    path = os.path.join(SCREENSHOT_DIR, f"target_{target_id}_thumb.png")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    return None
+
 def load_screenshot(target_id):
-    """加载截图（根据配置自动选择存储方式）"""
+    """加载截图的 PNG 字节（根据配置自动选择存储方式），不存在时返回 None"""
     if USE_DB_SCREENSHOT:
         screenshot = Screenshot.query.filter_by(target_id=target_id).first()
         if screenshot:
-            return Image.open(io.BytesIO(screenshot.image_data))
+            return screenshot.image_data
         return None
     else:
         path = os.path.join(SCREENSHOT_DIR, f"target_{target_id}.png")
         if os.path.exists(path):
-            return Image.open(path)
+            with open(path, 'rb') as f:
+                return f.read()
         return None
 
 def screenshot_exists(target_id):
@@ -332,65 +965,325 @@ def screenshot_exists(target_id):
         return Screenshot.query.filter_by(target_id=target_id).first() is not None
     else:
         return os.path.exists(os.path.join(SCREENSHOT_DIR, f"target_{target_id}.png"))
-# [MODIFIED] 强制设置窗口大小，解决响应式布局问题
-def get_screenshot(driver, url, width, max_height):
+# [NEW] 单次检查的时间预算
+class CheckTimeout(Exception):
+    """检查超出时间预算"""
+
+class CheckBudget:
+    """
+    单次检查的端到端截止时间
+
+    导航、登录、渲染等待和截图共享同一个预算：每一步之前都会按剩余时间
+    重新设置浏览器的页面加载/脚本超时，预算耗尽时停止页面加载并抛出 CheckTimeout。
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+        self.stage = '开始'
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def elapsed(self):
+        return self.seconds - (self.deadline - time.monotonic())
+
+    def cap(self, seconds):
+        """把某一步自身的超时限制在剩余预算之内（至少 1 秒）"""
+        return max(1, math.ceil(min(seconds, self.remaining())))
+
+    def check(self, stage):
+        self.stage = stage
+        if self.remaining() <= 0:
+            raise CheckTimeout(f"超出时间预算 {self.seconds} 秒 (阶段: {stage})")
+
+    def apply(self, driver):
+        timeout = self.cap(self.seconds)
+        driver.set_page_load_timeout(timeout)
+        driver.set_script_timeout(timeout)
+
+    def navigate(self, driver, url, stage='导航'):
+        from selenium.common.exceptions import TimeoutException
+
+        self.check(stage)
+        self.apply(driver)
+        try:
+            driver.get(url)
+        except TimeoutException:
+            stop_page_loading(driver)
+            raise CheckTimeout(f"超出时间预算 {self.seconds} 秒 (阶段: {stage})")
+
+    def sleep(self, seconds, stage):
+        """等待页面稳定；剩余预算不足以等满时立即停止加载并超时，尽早释放浏览器"""
+        self.check(stage)
+        if self.remaining() < seconds:
+            raise CheckTimeout(f"剩余预算 {self.remaining():.0f} 秒不足以完成{stage} ({seconds} 秒)")
+        time.sleep(seconds)
+
+def stop_page_loading(driver):
+    """停止当前页面的加载（优先 CDP，失败时退回 window.stop()）"""
+    try:
+        driver.execute_cdp_cmd('Page.stopLoading', {})
+    except Exception:
+        try:
+            driver.execute_script('window.stop();')
+        except Exception as e:
+            print(f"[WARN] 停止页面加载失败: {e}")
+
+# [NEW] 截图方式
+# stitch: 窗口保持视口大小，测量文档实际高度（不超过 max_height）后逐段滚动截图并拼接，
+#         浏览器每次只光栅化一个视口，内存与 max_height 无关（默认）
+# window: 旧方式，把窗口直接拉到 width x max_height 一次截图
+SCREENSHOT_CAPTURE_MODE = os.environ.get('SCREENSHOT_CAPTURE_MODE', 'stitch').lower()
+VIEWPORT_HEIGHT = 1080
+STRIP_SETTLE_SECONDS = 0.3  # 每次滚动后等待懒加载图片和重绘
+
+# 读取视口尺寸与文档高度（CSS 像素）
+PAGE_METRICS_SCRIPT = """
+const doc = document.documentElement, body = document.body || doc;
+return [window.innerWidth, window.innerHeight,
+        Math.max(doc.scrollHeight, body.scrollHeight, doc.offsetHeight, body.offsetHeight)];
+"""
+# 隐藏 fixed / sticky 元素，避免吸顶导航栏在每一段截图中重复出现
+HIDE_FIXED_ELEMENTS_SCRIPT = """
+for (const el of document.querySelectorAll('body *')) {
+    const position = getComputedStyle(el).position;
+    if (position === 'fixed' || position === 'sticky') el.style.setProperty('visibility', 'hidden', 'important');
+}
+"""
+
+def capture_full_page(driver, max_height, budget):
+    """
+    分段截取整页（拼接在图像处理进程中完成，见 analyze_capture）
+
+    Args:
+        driver: WebDriver 实例，窗口应已设置为目标宽度 x 视口高度
+        max_height: 截图高度上限（CSS 像素）
+        budget: CheckBudget 时间预算
+
+    Returns:
+        dict: strips（各段 PNG 字节）、offsets（各段滚动位置）、view_width、total_height
+    """
+    view_width, view_height, doc_height = driver.execute_script(PAGE_METRICS_SCRIPT)
+    total_height = max(1, min(int(doc_height), max_height))
+    print(f"[DEBUG][capture_full_page] 文档高度 {doc_height}px，截取 {total_height}px，视口 {view_width}x{view_height}")
+
+    strips, offsets = [], []
+    y = 0
+    while y < total_height:
+        budget.check('分段截图')
+        # 接近页面底部时浏览器会把滚动位置钳制在 (文档高度 - 视口高度)，以实际位置为准
+        scroll_y = driver.execute_script("window.scrollTo(0, arguments[0]); return window.scrollY;", y)
+        if y > 0:
+            if y == view_height:
+                driver.execute_script(HIDE_FIXED_ELEMENTS_SCRIPT)
+            time.sleep(STRIP_SETTLE_SECONDS)
+        strips.append(driver.get_screenshot_as_png())
+        offsets.append(scroll_y)
+        y += view_height
+    driver.execute_script("window.scrollTo(0, 0);")
+    return {'strips': strips, 'offsets': offsets, 'view_width': view_width, 'total_height': total_height}
+
+# [MODIFIED] 强制设置窗口宽度，解决响应式布局问题
+def get_screenshot(driver, url, width, max_height, budget=None):
+    """访问页面并截图，返回原始截图数据（格式同 capture_full_page），交给 analyze_capture 处理"""
+    budget = budget or CheckBudget(CHECK_TIMEOUT_SECONDS)
     print(f"[DEBUG][get_screenshot] 准备截图，URL: {url}")
     
     # 1. 访问页面
-    driver.get(url)
-    
-    # 2. 强制设置窗口大小为用户指定的尺寸
-    # 这样可以模拟固定的显示器分辨率 (如 1920x1080)
-    # 不再依赖 document.body.scrollHeight，避免动态加载页面的高度计算干扰
-    driver.set_window_size(width, max_height)
+    budget.navigate(driver, url)
     
-    print(f"[DEBUG] 已强制设置窗口尺寸: {width}x{max_height}")
+    # 2. 设置窗口大小
+    # 宽度固定为用户指定值，模拟固定的显示器分辨率 (如 1920x1080)
+    if SCREENSHOT_CAPTURE_MODE == 'window':
+        driver.set_window_size(width, max_height)
+        print(f"[DEBUG] 已强制设置窗口尺寸: {width}x{max_height}")
+    else:
+        # 分段模式只需视口大小的窗口；尺寸已一致时不再调整，避免多一次重新布局
+        size = driver.get_window_size()
+        if size.get('width') != width or size.get('height') != VIEWPORT_HEIGHT:
+            driver.set_window_size(width, VIEWPORT_HEIGHT)
+            print(f"[DEBUG] 已设置窗口尺寸: {width}x{VIEWPORT_HEIGHT}")
     
     # 3. 等待页面元素加载和布局稳定
     # YouTube 等动态网站图片加载较慢，Eager模式下必须手动多等一会儿
     # 建议设置为 20 秒，确保图片、字体和布局完全渲染
     print("[DEBUG] 等待页面渲染 (20秒)...")
-    time.sleep(20)
+    budget.sleep(20, '等待渲染')
     
     # 4. 截图
-    png = driver.get_screenshot_as_png()
+    budget.check('截图')
+    if SCREENSHOT_CAPTURE_MODE == 'window':
+        capture = {'strips': [driver.get_screenshot_as_png()], 'offsets': [0], 'view_width': None, 'total_height': None}
+    else:
+        capture = capture_full_page(driver, max_height, budget)
     print("[DEBUG][get_screenshot] 截图成功。")
     
-    return Image.open(io.BytesIO(png))
+    return capture
 
-def images_are_different(img1, img2, hamming_distance_threshold):
-    hash1 = imagehash.dhash(img1)
-    hash2 = imagehash.dhash(img2)
-    distance = hash1 - hash2
+def is_legacy_capture(target):
+    """
+    旧快照的截图方式是否与当前不同（需要重建基准）
+
+    升级前保存的快照没有记录截图方式（列为空），都是整窗截取的；
+    切换 SCREENSHOT_CAPTURE_MODE 后，之前的快照同样不能直接对比。
+    """
+    return (target.screenshot_capture_mode or 'window') != SCREENSHOT_CAPTURE_MODE
+
+# --- [NEW] 图像对比引擎 ---
+# 每次截图只做一次灰度转换，并缩小到宽度不超过 COMPARE_MAX_WIDTH 的数组；
+# 空白页检测和所有对比引擎都基于这份数组（有裁剪区域时使用该区域的数组）。
+# 各引擎返回“差异分数”，分数大于目标的阈值即视为变化，分数的单位见 COMPARATORS 的说明。
+COMPARE_MAX_WIDTH = 512
+PIXEL_DIFF_TOLERANCE = 24  # 像素差引擎：灰度差超过此值的像素才计为变化，忽略抗锯齿等渲染噪点
+COMPARATORS = {}  # 引擎名 -> (显示名称, 阈值说明, 默认阈值, 对比函数)
+DEFAULT_COMPARE_ENGINE = 'dhash'
+
+def register_comparator(name, label, unit, default_threshold):
+    """注册对比引擎；对比函数接收 (旧数组, 新数组)，返回差异分数"""
+    def decorator(func):
+        COMPARATORS[name] = (label, unit, default_threshold, func)
+        return func
+    return decorator
+
+def default_threshold(engine):
+    """引擎的默认阈值，未知引擎按默认引擎处理"""
+    return COMPARATORS.get(engine, COMPARATORS[DEFAULT_COMPARE_ENGINE])[2]
+
+class ComparisonInput:
+    """一次截图的对比数据：整页灰度缩略数组、对比区域数组与整页原始分辨率的亮度统计"""
+
+    def __init__(self, img, crop_box=None):
+        import numpy as np
+        from PIL import ImageStat
+
+        gray = img.convert('L')
+        # 空白页检测必须基于原始分辨率：缩小时的像素平均会明显压低标准差，稀疏的文字页会被误判为空白。
+        # ImageStat 基于直方图计算，不需要为整页分配浮点数组
+        stat = ImageStat.Stat(gray)
+        self.std_dev, self.mean_brightness = stat.stddev[0], stat.mean[0]
+        self.page = np.asarray(self._downscale(gray))
+        if crop_box:
+            self.region = np.asarray(self._downscale(gray.crop(crop_box)))
+        else:
+            self.region = self.page
+
+    @staticmethod
+    def _downscale(gray):
+        factor = math.ceil(gray.width / COMPARE_MAX_WIDTH)
+        return gray.reduce(factor) if factor > 1 else gray
+
+def parse_crop_box(crop_area):
+    """解析目标的裁剪区域 JSON，无效时返回 None"""
+    try:
+        crop_box = json.loads(crop_area or '[]')
+        if isinstance(crop_box, list) and len(crop_box) == 4 and crop_box[2] > crop_box[0] and crop_box[3] > crop_box[1]:
+            return tuple(crop_box)
+    except (json.JSONDecodeError, TypeError, ValueError, IndexError): pass
+    return None
+
+def _match_shape(last, current):
+    """页面高度变化时把旧数组缩放到新数组的尺寸，便于逐像素对比"""
+    if last.shape == current.shape:
+        return last
+    import numpy as np
+    from PIL import Image
+
+    return np.asarray(Image.fromarray(last).resize((current.shape[1], current.shape[0]), Image.BILINEAR))
+
+def _image_hash_distance(hash_func, last, current):
+    from PIL import Image
+
+    hash1 = hash_func(Image.fromarray(last))
+    hash2 = hash_func(Image.fromarray(current))
     print(f"[DEBUG] 图片1哈希: {hash1}")
     print(f"[DEBUG] 图片2哈希: {hash2}")
-    print(f"[DEBUG] 计算出的汉明距离: {distance}")
-    return distance > hamming_distance_threshold
+    return hash1 - hash2
+
+@register_comparator('dhash', '差异哈希 dHash (默认)', '汉明距离', 5)
+def compare_dhash(last, current):
+    import imagehash
+    return _image_hash_distance(imagehash.dhash, last, current)
+
+@register_comparator('phash', '感知哈希 pHash', '汉明距离', 8)
+def compare_phash(last, current):
+    import imagehash
+    return _image_hash_distance(imagehash.phash, last, current)
+
+@register_comparator('whash', '小波哈希 wHash', '汉明距离', 5)
+def compare_whash(last, current):
+    import imagehash
+    return _image_hash_distance(imagehash.whash, last, current)
+
+def _box_mean(a, k):
+    """k x k 均值滤波（积分图实现，只保留完整窗口的区域）"""
+    import numpy as np
+
+    c = np.pad(a, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    return (c[k:, k:] - c[:-k, k:] - c[k:, :-k] + c[:-k, :-k]) / (k * k)
+
+@register_comparator('ssim', '结构相似度 SSIM', '(1 - SSIM) x 100', 0.5)
+def compare_ssim(last, current, window=7):
+    import numpy as np
+
+    x = _match_shape(last, current).astype(np.float64)
+    y = current.astype(np.float64)
+    if min(x.shape) < window:
+        window = max(1, min(x.shape))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = _box_mean(x, window), _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mu_x ** 2
+    var_y = _box_mean(y * y, window) - mu_y ** 2
+    cov = _box_mean(x * y, window) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    score = float(ssim_map.mean())
+    print(f"[DEBUG] SSIM: {score:.4f}")
+    return (1 - score) * 100
+
+@register_comparator('pixel', '像素变化比例', '变化像素百分比', 0.5)
+def compare_pixel_ratio(last, current):
+    import numpy as np
+
+    diff = np.abs(_match_shape(last, current).astype(np.int16) - current.astype(np.int16))
+    return float((diff > PIXEL_DIFF_TOLERANCE).mean() * 100)
+
+def images_are_different(last, current, threshold, engine=DEFAULT_COMPARE_ENGINE):
+    """
+    使用指定引擎对比两份灰度数组
+
+    Args:
+        last, current: ComparisonInput 中的灰度数组
+        threshold: 阈值，单位取决于引擎
+        engine: 引擎名，未知时退回默认引擎
 
-def is_blank_page(img, std_threshold=10):
+    Returns:
+        bool: 差异分数是否超过阈值
+    """
+    if engine not in COMPARATORS:
+        engine = DEFAULT_COMPARE_ENGINE
+    label, unit, _, func = COMPARATORS[engine]
+    score = func(last, current)
+    print(f"[DEBUG] 对比引擎 {engine}: {unit} = {score:.2f} (阈值 {threshold})")
+    return score > threshold
+
+def is_blank_page(data, std_threshold=10):
     """
     检测图片是否为空白/加载失败的页面
     通过计算像素标准差来判断：正常页面有丰富内容，标准差较高；
     空白/单色页面的标准差接近0
     
     Args:
-        img: PIL Image 对象
+        data: ComparisonInput（使用其整页原始分辨率的灰度统计）
         std_threshold: 标准差阈值，低于此值视为空白页（默认10）
     
     Returns:
         bool: True 表示是空白页/加载失败，False 表示正常页面
     """
-    import numpy as np
+    # 像素值的标准差
+    std_dev = data.std_dev
     
-    # 转换为灰度图进行分析，减少计算量
-    gray_img = img.convert('L')
-    pixels = np.array(gray_img)
-    
-    # 计算像素值的标准差
-    std_dev = np.std(pixels)
-    
-    # 计算平均亮度（用于判断是白屏还是黑屏）
-    mean_brightness = np.mean(pixels)
+    # 平均亮度（用于判断是白屏还是黑屏）
+    mean_brightness = data.mean_brightness
     
     print(f"[DEBUG][is_blank_page] 像素标准差: {std_dev:.2f}, 平均亮度: {mean_brightness:.2f}")
     
@@ -406,6 +1299,218 @@ def is_blank_page(img, std_threshold=10):
     
     return False
 
+# --- [NEW] 图像处理进程池 ---
+# PNG 解码/编码、分段拼接、哈希与统计都是 CPU 密集操作，在 Web 进程的线程里执行会长时间持有 GIL，
+# 导致页面卡顿。这些工作交给独立进程完成：调用方只传入原始截图字节，取回 PNG、缩略数组、
+# 对比结论等紧凑结果。较大的字节数据（双向）通过共享内存传递，避免经管道序列化复制。
+# IMAGE_WORKERS=0 时在调用线程内直接执行。
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_TASK_TIMEOUT = 120
+SHARED_MEMORY_MIN_BYTES = 256 * 1024
+THUMBNAIL_WIDTH = 360
+
+class SharedBytes:
+    """放在共享内存中的一段字节数据的引用（可跨进程传递）"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+@contextmanager
+def open_shared_bytes(data):
+    """在工作进程中读取 SharedBytes（普通 bytes 原样返回），退出时释放对共享内存的引用"""
+    if not isinstance(data, SharedBytes):
+        yield data
+        return
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = SharedMemory(name=data.name)
+    view = shm.buf[:data.size]
+    try:
+        yield view
+    finally:
+        view.release()
+        shm.close()
+
+def share_result_bytes(data):
+    """[工作进程] 较大的结果字节放入共享内存后返回 SharedBytes，由 ImageWorkerPool.run 取回并释放"""
+    import multiprocessing
+
+    # IMAGE_WORKERS=0 时在调用进程内执行，直接返回
+    if multiprocessing.parent_process() is None or len(data) < SHARED_MEMORY_MIN_BYTES:
+        return data
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return SharedBytes(shm.name, len(data))
+
+def decode_png(data):
+    """解码 PNG（bytes 或 SharedBytes），返回已完整加载的 PIL 图片"""
+    from PIL import Image
+
+    with open_shared_bytes(data) as buf:
+        img = Image.open(io.BytesIO(buf))
+        img.load()
+    return img
+
+def encode_png(img):
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+class ImageWorkerPool:
+    """图像处理进程池（spawn 方式启动，首次使用时创建）"""
+
+    def __init__(self, workers=IMAGE_WORKERS):
+        self._workers = workers
+        self._executor = None
+        self._lock = Lock()
+        self.tasks_total = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # 不使用 fork：父进程里有调度器、浏览器池等线程，fork 后锁状态不可预期
+                self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                print(f"[ImagePool] 图像处理进程池已启动 ({self._workers} 个进程)")
+            return self._executor
+
+    def _share(self, value, segments):
+        """把较大的 bytes 放入共享内存，列表/元组逐项处理"""
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._share(item, segments) for item in value)
+        if isinstance(value, bytes) and len(value) >= SHARED_MEMORY_MIN_BYTES:
+            from multiprocessing.shared_memory import SharedMemory
+
+            shm = SharedMemory(create=True, size=len(value))
+            shm.buf[:len(value)] = value
+            segments.append(shm)
+            return SharedBytes(shm.name, len(value))
+        return value
+
+    def _collect(self, value):
+        """取回工作进程放入共享内存的结果字节并释放共享内存，dict 逐项处理"""
+        if isinstance(value, dict):
+            return {key: self._collect(item) for key, item in value.items()}
+        if isinstance(value, SharedBytes):
+            from multiprocessing.shared_memory import SharedMemory
+
+            shm = SharedMemory(name=value.name)
+            try:
+                return bytes(shm.buf[:value.size])
+            finally:
+                shm.close()
+                shm.unlink()
+        return value
+
+    def run(self, func, *args):
+        """在进程池中执行 func(*args) 并等待结果"""
+        self.tasks_total += 1
+        if self._workers <= 0:
+            return func(*args)
+        from concurrent.futures.process import BrokenProcessPool
+
+        segments = []
+        try:
+            shared_args = [self._share(arg, segments) for arg in args]
+            return self._collect(self._get_executor().submit(func, *shared_args).result(timeout=IMAGE_TASK_TIMEOUT))
+        except BrokenProcessPool:
+            # 工作进程异常退出（如被 OOM 杀掉）后进程池不可再用，下次调用时重建
+            print("[ImagePool] 进程池已损坏，将在下次使用时重建")
+            with self._lock:
+                self._executor = None
+            raise
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self):
+        return {'workers': self._workers, 'started': self._executor is not None, 'tasks_total': self.tasks_total}
+
+# 全局图像处理进程池实例
+image_pool = ImageWorkerPool()
+
+# 以下函数在图像处理进程中执行，参数与返回值都必须可序列化
+def analyze_capture(strips, offsets, view_width, total_height, crop_box):
+    """
+    [工作进程] 拼接截图并计算对比数据
+
+    Args:
+        strips: 各段截图的 PNG 数据；window 模式只有一段
+        offsets: 各段的滚动位置（CSS 像素）
+        view_width: 视口宽度（CSS 像素），window 模式为 None
+        total_height: 拼接后的高度（CSS 像素），window 模式为 None
+        crop_box: 对比区域，None 表示整页
+
+    Returns:
+        dict: png（拼接后的 PNG 字节；window 模式为 None，调用方直接保存原始截图）、
+              thumbnail（带监控区域红框的预览缩略图）、blank（是否空白页）、region（对比区域的灰度数组）
+    """
+    from PIL import Image
+
+    png = None
+    if view_width is None:
+        img = decode_png(strips[0])
+    else:
+        img = None
+        for data, scroll_y in zip(strips, offsets):
+            strip = decode_png(data)
+            # 设备像素比不为 1 时，截图像素与 CSS 像素按比例换算
+            scale = strip.width / view_width
+            if img is None:
+                img = Image.new('RGB', (strip.width, round(total_height * scale)), 'white')
+            img.paste(strip.convert('RGB'), (0, round(scroll_y * scale)))
+            strip.close()
+        png = share_result_bytes(encode_png(img))
+    data = ComparisonInput(img, crop_box)
+    return {
+        'png': png,
+        'thumbnail': make_thumbnail(img, crop_box),
+        'blank': is_blank_page(data),
+        'region': data.region,
+    }
+
+def compare_with_baseline(baseline_png, current_region, crop_box, threshold, engine):
+    """[工作进程] 与旧快照对比，返回是否发生变化"""
+    last_img = decode_png(baseline_png)
+    return images_are_different(ComparisonInput(last_img, crop_box).region, current_region, threshold, engine)
+
+def make_thumbnail(img, crop_box):
+    """[工作进程] 生成带监控区域红框的预览缩略图"""
+    from PIL import ImageDraw
+
+    # 取页面顶部 16:9 区域缩小，与仪表盘中的预览框比例一致；裁剪得到的是副本，不影响原图
+    thumb = img.crop((0, 0, img.width, min(img.height, img.width * 9 // 16)))
+    if crop_box:
+        ImageDraw.Draw(thumb).rectangle(crop_box, outline="red", width=5)
+    thumb.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))
+    return encode_png(thumb)
+
+def render_screenshot(png, crop_box, thumbnail):
+    """[工作进程] 在截图上绘制监控区域红框，可选生成缩略图"""
+    from PIL import ImageDraw
+
+    img = decode_png(png)
+    if thumbnail:
+        return make_thumbnail(img, crop_box)
+    if crop_box:
+        draw = ImageDraw.Draw(img)
+        draw.rectangle(crop_box, outline="red", width=5)
+    return share_result_bytes(encode_png(img))
+
 # [MODIFIED] 使用 smtplib 替代 msmtp
 def send_email(subject, content, config):
     if not all([config.to_email, config.smtp_host, config.smtp_user, config.smtp_password]):
@@ -498,20 +1603,474 @@ def send_pushplus_notification(title, content, config):
     except Exception as e: print(f"发送 PushPlus 通知时发生异常: {e}")
 
 
+# --- [NEW] 通知合并与限流 ---
+# 公共布局变化会让几十个目标同时报告变化，逐条发送会触发 Telegram / PushPlus 的频率限制。
+# 变化事件先进入合并窗口（同一目标在窗口内只保留一条），窗口结束后每个渠道只发一条合并消息；
+# 每个渠道各自有令牌桶，令牌不足时消息留到令牌恢复后再发。
+# 渠道 -> (令牌桶容量, 每分钟恢复的令牌数)
+NOTIFICATION_RATE_LIMITS = {
+    'email': (5, 2),
+    'telegram': (20, 20),
+    'bark': (10, 10),
+    'pushplus': (3, 1),
+}
+
+class TokenBucket:
+    """令牌桶限流器"""
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self):
+        """距离下一个令牌可用还需要的秒数"""
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+def notification_channel_enabled(channel, config):
+    if channel == 'email':
+        return all([config.to_email, config.smtp_host, config.smtp_user, config.smtp_password])
+    if channel == 'telegram':
+        return bool(config.telegram_bot_token and config.telegram_chat_id)
+    if channel == 'bark':
+        return bool(config.bark_url)
+    if channel == 'pushplus':
+        return bool(config.pushplus_token)
+    return False
+
+def format_change_digest(events):
+    """
+    把一组变化事件整理为通知内容
+
+    Returns:
+        tuple: (标题, 纯文本内容, Telegram HTML 内容)
+    """
+    if len(events) == 1:
+        event = events[0]
+        now_str = event['last_seen'].strftime('%Y-%m-%d %H:%M:%S')
+        subject = f"网页变化提醒: {event['name'] or event['url']}"
+        content = f"[{now_str}] 监控目标 '{event['name']}' ({event['url']}) 检测到页面发生视觉变化。"
+        if event['count'] > 1:
+            content += f" (窗口内共 {event['count']} 次)"
+        tg_message = f"<b>网页变化提醒</b>\n\n<b>目标:</b> {event['name']}\n<b>网址:</b> {event['url']}\n\n检测到页面有新变化！\n<b>时间:</b> {now_str}"
+        return subject, content, tg_message
+
+    subject = f"网页变化提醒: {len(events)} 个目标发生变化"
+    lines, tg_lines = [], []
+    for event in events:
+        time_str = event['last_seen'].strftime('%m-%d %H:%M:%S')
+        times = f" x{event['count']}" if event['count'] > 1 else ''
+        lines.append(f"- [{time_str}] {event['name'] or '未命名目标'} ({event['url']}){times}")
+        tg_lines.append(f"• <b>{event['name'] or '未命名目标'}</b>{times}\n  {event['url']} ({time_str})")
+    content = f"以下 {len(events)} 个监控目标检测到页面发生视觉变化：\n" + "\n".join(lines)
+    tg_message = f"<b>网页变化提醒</b>\n\n共 {len(events)} 个目标有新变化：\n\n" + "\n".join(tg_lines)
+    return subject, content, tg_message
+
+class NotificationDispatcher:
+    """变化通知的合并窗口、同目标去重与分渠道限流"""
+
+    def __init__(self, rate_limits=NOTIFICATION_RATE_LIMITS):
+        self._buckets = {channel: TokenBucket(*limit) for channel, limit in rate_limits.items()}
+        self._pending = {channel: {} for channel in rate_limits}  # 渠道 -> {target_id: 事件}
+        self._lock = Lock()
+        self._timer = None
+        self.sent_total = {channel: 0 for channel in rate_limits}
+        self.deferred_total = {channel: 0 for channel in rate_limits}
+
+    def add_change(self, target, config):
+        """记录一次变化事件；未开启合并时立即发送（仍受限流约束）"""
+        window = (config.digest_window_seconds or 0) if config else 0
+        now = datetime.now()
+        with self._lock:
+            for channel, pending in self._pending.items():
+                if config and not notification_channel_enabled(channel, config):
+                    continue
+                event = pending.get(target.id)
+                if event:
+                    event['count'] += 1
+                    event['last_seen'] = now
+                else:
+                    pending[target.id] = {'target_id': target.id, 'name': target.name, 'url': target.url,
+                                          'first_seen': now, 'last_seen': now, 'count': 1}
+        if window > 0:
+            print(f"[Notify] 变化事件已加入合并窗口 ({window} 秒): {target.name or target.url}")
+            self._schedule(window)
+        else:
+            self.flush(config)
+
+    def _schedule(self, delay):
+        """在 delay 秒后发送（已有待触发的定时器时不重复创建，窗口从第一条事件开始计算）"""
+        from threading import Timer
+
+        with self._lock:
+            if self._timer and self._timer.is_alive():
+                return
+            self._timer = Timer(delay, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            with flask_app.app_context():
+                self.flush(NotificationSettings.query.first())
+        except Exception as e:
+            print(f"[Notify] 发送合并通知时发生异常: {e}")
+            traceback.print_exc()
+
+    def flush(self, config):
+        """每个渠道把待发送事件合并为一条消息发送；令牌不足的渠道稍后重试"""
+        if not config:
+            return
+        retry_after = None
+        for channel, bucket in self._buckets.items():
+            with self._lock:
+                if not self._pending[channel]:
+                    continue
+                if not bucket.try_acquire():
+                    wait = bucket.wait_time()
+                    self.deferred_total[channel] += 1
+                    print(f"[Notify] {channel} 渠道触发限流，{len(self._pending[channel])} 条事件将在 {wait:.0f} 秒后合并发送")
+                    retry_after = wait if retry_after is None else min(retry_after, wait)
+                    continue
+                events = sorted(self._pending[channel].values(), key=lambda e: e['first_seen'])
+                self._pending[channel] = {}
+            self._send(channel, events, config)
+        if retry_after is not None:
+            self._schedule(max(retry_after, 1))
+
+    def _send(self, channel, events, config):
+        subject, content, tg_message = format_change_digest(events)
+        if channel == 'email':
+            send_email(subject, content, config)
+        elif channel == 'telegram':
+            send_telegram_notification(tg_message, config)
+        elif channel == 'bark':
+            send_bark_notification(subject, content, config)
+        elif channel == 'pushplus':
+            send_pushplus_notification(subject, content, config)
+        self.sent_total[channel] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': {channel: len(pending) for channel, pending in self._pending.items()},
+                'sent_total': dict(self.sent_total),
+                'deferred_total': dict(self.deferred_total),
+                'tokens': {channel: round(bucket.tokens, 2) for channel, bucket in self._buckets.items()},
+            }
+
+# 全局通知分发实例
+notification_dispatcher = NotificationDispatcher()
+
+
+# --- [NEW] 实时状态：事件总线与摘要缓存 ---
+# 仪表盘通过 SSE 订阅检查开始 / 结束 / 变化事件并增量更新表格，不再需要整页刷新。
+# 事件总线只在本进程内广播：SSE 连接需要落在运行检查（worker 角色）的进程上。
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', 4))  # 每个 SSE 连接占用一个 Gunicorn 线程
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_SECONDS = 300  # 连接到期后由浏览器 EventSource 自动重连，避免长期占用线程
+SUMMARY_CACHE_SECONDS = 10
+
+class EventBus:
+    """进程内事件广播，每个订阅者一个有界队列，慢客户端的事件直接丢弃"""
+
+    def __init__(self, max_subscribers=SSE_MAX_SUBSCRIBERS):
+        self._subscribers = []
+        self._lock = Lock()
+        self._max_subscribers = max_subscribers
+
+    def subscribe(self):
+        """返回新订阅者的队列；订阅数已满时返回 None"""
+        with self._lock:
+            if len(self._subscribers) >= self._max_subscribers:
+                return None
+            q = queue.Queue(maxsize=100)
+            self._subscribers.append(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish(self, event_type, data):
+        event = dict(data, type=event_type)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass
+
+# 全局事件总线实例
+event_bus = EventBus()
+# 正在执行检查的目标 ID
+running_checks = set()
+summary_cache = {'value': None, 'expires': 0.0}
+summary_cache_lock = Lock()
+
+def target_to_dict(target):
+    """目标的状态信息（时间字段同时给出仪表盘使用的展示格式），包含尚未写回数据库的检查结果"""
+    last_checked = bookkeeping_buffer.value(target, 'last_checked')
+    last_changed = bookkeeping_buffer.value(target, 'last_changed')
+    return {
+        'id': target.id,
+        'name': target.name,
+        'url': target.url,
+        'is_active': target.is_active,
+        'schedule_type': target.schedule_type,
+        'interval_minutes': target.interval_minutes,
+        'cron_schedule': target.cron_schedule,
+        'last_checked': last_checked.isoformat() if last_checked else None,
+        'last_checked_display': last_checked.strftime('%m-%d %H:%M') if last_checked else '-',
+        'last_changed': last_changed.isoformat() if last_changed else None,
+        'last_changed_display': last_changed.strftime('%m-%d %H:%M') if last_changed else None,
+        'last_changed_title': last_changed.strftime('%Y-%m-%d %H:%M:%S') if last_changed else None,
+        'last_status': bookkeeping_buffer.value(target, 'last_status'),
+        'running': target.id in running_checks,
+    }
+
+def target_summary():
+    """目标数量与状态汇总，缓存 SUMMARY_CACHE_SECONDS 秒（进行中的检查数取自内存，始终为最新值）"""
+    with summary_cache_lock:
+        if summary_cache['value'] is not None and time.monotonic() < summary_cache['expires']:
+            return dict(summary_cache['value'], running=len(running_checks))
+    by_status = dict(db.session.query(MonitorTarget.last_status, db.func.count(MonitorTarget.id))
+                     .group_by(MonitorTarget.last_status).all())
+    # 把尚未写回的检查结果计入汇总
+    pending_status = {tid: fields['last_status'] for tid, fields in bookkeeping_buffer.pending().items()
+                      if 'last_status' in fields}
+    if pending_status:
+        stored = db.session.query(MonitorTarget.id, MonitorTarget.last_status).filter(
+            MonitorTarget.id.in_(pending_status)).all()
+        for target_id, status in stored:
+            by_status[status] -= 1
+            by_status[pending_status[target_id]] = by_status.get(pending_status[target_id], 0) + 1
+        by_status = {status: count for status, count in by_status.items() if count}
+    summary = {
+        'total': sum(by_status.values()),
+        'active': MonitorTarget.query.filter_by(is_active=True).count(),
+        'by_status': {status or 'never': count for status, count in by_status.items()},
+    }
+    with summary_cache_lock:
+        summary_cache['value'] = summary
+        summary_cache['expires'] = time.monotonic() + SUMMARY_CACHE_SECONDS
+    return dict(summary, running=len(running_checks))
+
+def invalidate_summary():
+    with summary_cache_lock:
+        summary_cache['value'] = None
+
+def publish_target_event(event_type, target, **extra):
+    """
+    广播目标事件（在应用上下文中调用），附带摘要
+
+    没有订阅者时直接返回，不做任何查询。摘要使用缓存（最多滞后 SUMMARY_CACHE_SECONDS 秒），
+    不在每个事件上清空重算，以免检查线程额外争用数据库。
+    事件推送只是附带功能：会话异常等导致查询失败时只记录日志，
+    不向调用者抛出，以免中断检查或掩盖检查本身的异常（常在 finally 中调用）。
+    """
+    if not event_bus.has_subscribers():
+        return
+    try:
+        event_bus.publish(event_type, dict(extra, target=target_to_dict(target), summary=target_summary()))
+    except Exception as e:
+        print(f"[Events] 推送 {event_type} 事件失败: {e}")
+
+
 # --- 4. 核心监控与调度逻辑 ---
+# [NEW] 簿记字段写回缓冲
+# last_checked / last_status / last_changed 这类簿记更新不再在检查事务中逐条提交，
+# 而是先写入内存缓冲，每隔 BOOKKEEPING_FLUSH_SECONDS 秒合并为一次批量 UPDATE，
+# 大幅减少 SQLite 写锁的争用。设为 0 时退回到随检查事务同步提交。
+# 默认只在本地 SQLite 模式下启用；外部数据库的并发写入没有这个瓶颈。
+BOOKKEEPING_FLUSH_SECONDS = float(os.environ.get('BOOKKEEPING_FLUSH_SECONDS', 0 if USE_DB_SCREENSHOT else 5))
+
+class BookkeepingBuffer:
+    """目标簿记字段的写回缓冲，按目标合并，定期批量提交"""
+
+    def __init__(self, flush_seconds=BOOKKEEPING_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._pending = {}  # target_id -> {字段: 值}
+        self._lock = Lock()
+        self._timer = None
+        self.flushed_rows = 0
+        self.flush_count = 0
+
+    def update(self, target, **fields):
+        """
+        更新目标的簿记字段
+
+        启用缓冲时，字段值以“已提交”的状态写入对象（当前会话不会再为它发起 UPDATE），
+        同时记入缓冲等待批量写回；未启用时直接赋值，由调用者的事务提交。
+        """
+        from sqlalchemy.orm.attributes import set_committed_value
+
+        if self.flush_seconds <= 0:
+            for name, value in fields.items():
+                setattr(target, name, value)
+            return
+        for name, value in fields.items():
+            set_committed_value(target, name, value)
+        with self._lock:
+            self._pending.setdefault(target.id, {}).update(fields)
+            if not (self._timer and self._timer.is_alive()):
+                from threading import Timer
+
+                self._timer = Timer(self.flush_seconds, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self, target_id=None):
+        """尚未写回的字段：指定目标时返回 {字段: 值}，否则返回 {target_id: {字段: 值}}（均为副本）"""
+        with self._lock:
+            if target_id is not None:
+                return dict(self._pending.get(target_id, {}))
+            return {tid: dict(fields) for tid, fields in self._pending.items()}
+
+    def value(self, target, name):
+        """
+        字段的当前值（优先取缓冲中尚未写回的值）
+
+        检查事务 commit 后对象会过期并从数据库重新加载，set_committed_value 写入的值随之丢失，
+        读取簿记字段时需要经由这里，才能看到本次检查的结果。
+        """
+        fields = self.pending(target.id)
+        return fields[name] if name in fields else getattr(target, name)
+
+    def apply(self, targets):
+        """把尚未写回的值以“已提交”状态套用到刚查询出的对象上（用于页面渲染）"""
+        from sqlalchemy.orm.attributes import set_committed_value
+
+        pending = self.pending()
+        for target in targets:
+            for name, value in pending.get(target.id, {}).items():
+                set_committed_value(target, name, value)
+        return targets
+
+    def _flush_from_timer(self):
+        try:
+            with flask_app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f"[Bookkeeping] 批量写回失败: {e}")
+            traceback.print_exc()
+
+    def flush(self):
+        """把缓冲中的更新按字段组合分组，每组一次 executemany（需在应用上下文中调用）"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+        if not pending:
+            return 0
+        table = MonitorTarget.__table__
+        groups = {}
+        for target_id, fields in pending.items():
+            groups.setdefault(tuple(sorted(fields)), []).append(dict(fields, target_id=target_id))
+        try:
+            with db.engine.begin() as conn:
+                for names, rows in groups.items():
+                    stmt = (table.update()
+                            .where(table.c.id == db.bindparam('target_id'))
+                            .values({name: db.bindparam(name) for name in names}))
+                    conn.execute(stmt, rows)
+        except Exception:
+            # 写回失败时放回缓冲（不覆盖期间产生的更新的值），等待下一次写回
+            with self._lock:
+                for target_id, fields in pending.items():
+                    self._pending[target_id] = dict(fields, **self._pending.get(target_id, {}))
+            raise
+        self.flushed_rows += len(pending)
+        self.flush_count += 1
+        # 汇总缓存可能是按写回前的数据库内容计算的
+        invalidate_summary()
+        print(f"[Bookkeeping] 已批量写回 {len(pending)} 个目标的检查记录")
+        return len(pending)
+
+    def flush_at_exit(self):
+        if flask_app is None:
+            return
+        try:
+            with flask_app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f"[Bookkeeping] 退出前写回失败: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.flush_seconds > 0, 'flush_seconds': self.flush_seconds,
+                    'pending': len(self._pending), 'flushed_rows': self.flushed_rows,
+                    'flush_count': self.flush_count}
+
+# 全局簿记写回缓冲实例
+bookkeeping_buffer = BookkeepingBuffer()
+
+# [NEW] 检查结果统计（进程内），通过 /api/checks 导出
+check_stats_lock = Lock()
+check_outcome_counts = {}
+timeout_counts_by_target = {}
+# 检查耗时滑动平均的平滑系数：越大越偏向最近几次检查
+CHECK_DURATION_SMOOTHING = 0.3
+
+def record_check_outcome(target, outcome, duration=None, **fields):
+    """记录一次检查的结果：更新进程内统计，并把 last_status / last_checked 等簿记字段交给写回缓冲"""
+    with check_stats_lock:
+        check_outcome_counts[outcome] = check_outcome_counts.get(outcome, 0) + 1
+        if outcome == 'timeout':
+            timeout_counts_by_target[target.id] = timeout_counts_by_target.get(target.id, 0) + 1
+    if duration is not None:
+        previous = bookkeeping_buffer.value(target, 'avg_check_seconds')
+        fields['avg_check_seconds'] = round(duration if previous is None
+                                            else previous + CHECK_DURATION_SMOOTHING * (duration - previous), 2)
+    bookkeeping_buffer.update(target, last_status=outcome, last_checked=datetime.now(), **fields)
+
 def execute_target_check(target_id):
     # [MODIFIED] 使用信号量进行并发控制
     # blocking=False: 如果当前已有足够多的浏览器在运行，则直接跳过本次检查，防止堆积
     # blocking=True: 会阻塞线程等待，直到有空闲资源
-    acquired = browser_semaphore.acquire(blocking=True, timeout=10) 
+    # [NEW] 进程正在优雅退出时不再启动新的浏览器
+    if browser_supervisor.draining:
+        print(f"[WARN] 正在退出，跳过任务 ID: {target_id}")
+        return
+    acquired = browser_semaphore.acquire(blocking=True, timeout=BROWSER_WAIT_SECONDS) 
     if not acquired:
-        print(f"[WARN] 系统繁忙，跳过任务 ID: {target_id} (并发限制: {MAX_CONCURRENT_BROWSERS})")
+        print(f"[WARN] 系统繁忙，跳过任务 ID: {target_id} (并发限制: {browser_semaphore.limit})")
+        with check_stats_lock:
+            check_outcome_counts['skipped'] = check_outcome_counts.get('skipped', 0) + 1
         return
 
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     driver = None
     try:
         print(f"\n[DEBUG] execute_target_check 函数被调用, 目标ID: {target_id}")
-        with app.app_context():
+        with flask_app.app_context():
             target = MonitorTarget.query.get(target_id)
             notifications_config = NotificationSettings.query.first()
             if not target: 
@@ -519,15 +2078,19 @@ def execute_target_check(target_id):
                 return
 
             print(f"--- [{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 开始检查: {target.name or target.url} ---")
+            running_checks.add(target.id)
+            publish_target_event('check_started', target)
+            # [NEW] 端到端时间预算：从获取浏览器开始，覆盖导航、登录、渲染等待和截图
+            budget = CheckBudget(target.check_timeout or CHECK_TIMEOUT_SECONDS)
             try:
                 # [MODIFIED] 从浏览器池获取实例，而非每次新建
                 driver = browser_pool.acquire()
                 
                 # 根据目标配置调整窗口大小
-                driver.set_window_size(target.screenshot_width, 1080)
-                print(f"[DEBUG] 已设置窗口大小: {target.screenshot_width}x1080")
+                driver.set_window_size(target.screenshot_width, VIEWPORT_HEIGHT)
+                print(f"[DEBUG] 已设置窗口大小: {target.screenshot_width}x{VIEWPORT_HEIGHT}")
                 
-                driver.get(target.url)
+                budget.navigate(driver, target.url)
                 print(f"[DEBUG] 已访问初始 URL: {target.url}")
                 
                 if target.login_method == 'cookie' and target.cookies:
@@ -537,103 +2100,124 @@ def execute_target_check(target_id):
                             if 'expiry' in cookie: cookie['expiry'] = int(cookie['expiry'])
                             driver.add_cookie(cookie)
                         print(f"[*] 成功加载 {len(cookies)} 个 Cookies。正在刷新页面...")
-                        driver.get(target.url)
+                        budget.navigate(driver, target.url, '加载 Cookies 后刷新')
+                    except CheckTimeout: raise
                     except Exception as e: print(f"[!!!] 加载 Cookies 失败: {e}")
 
                 elif target.login_method == 'credentials' and all([target.login_username, target.login_password, target.username_selector, target.password_selector, target.submit_button_selector]):
                     try:
-                        wait = WebDriverWait(driver, 10)
+                        budget.check('登录')
+                        wait = WebDriverWait(driver, budget.cap(10))
                         user_field = wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, target.username_selector)))
                         user_field.send_keys(target.login_username)
                         driver.find_element(By.CSS_SELECTOR, target.password_selector).send_keys(target.login_password)
                         driver.find_element(By.CSS_SELECTOR, target.submit_button_selector).click()
                         print("[*] 已提交登录表单，等待 5 秒让页面跳转...")
-                        time.sleep(5)
+                        budget.sleep(5, '等待登录跳转')
+                    except CheckTimeout: raise
                     except Exception as e: print(f"[!!!] 账号密码登录失败: {e}")
 
-                current_img = get_screenshot(driver, target.url, target.screenshot_width, target.screenshot_max_height)
+                raw_capture = get_screenshot(driver, target.url, target.screenshot_width, target.screenshot_max_height, budget)
+                # [NEW] 拼接、编码与对比数组的计算都在图像处理进程中完成，本线程只等待紧凑结果
+                crop_box = parse_crop_box(target.crop_area)
+                capture = image_pool.run(analyze_capture, raw_capture['strips'], raw_capture['offsets'],
+                                         raw_capture['view_width'], raw_capture['total_height'], crop_box)
                 
                 # [NEW] 空白页检测：防止加载失败时的误报
-                if is_blank_page(current_img):
+                if capture['blank']:
                     print(f"[!!!] 页面加载失败（检测到空白/异常页面），跳过本次检测: {target.url}")
                     print(f"[!!!] 不更新截图，不触发变化通知，保留上次正常的快照")
-                    target.last_checked = datetime.now()
+                    record_check_outcome(target, 'blank', duration=budget.elapsed())
                     db.session.commit()
                     return  # 直接返回，不保存截图，不进行对比
                 
-                # [MODIFIED] 使用辅助函数检查和加载旧截图
-                if screenshot_exists(target.id):
+                # [MODIFIED] 使用辅助函数加载旧截图
+                baseline_png = load_screenshot(target.id)
+                if baseline_png is not None and is_legacy_capture(target):
+                    # [NEW] 旧快照由其他截图方式（如升级前的整窗截图）生成，尺寸不可比，直接重建基准
+                    print(f"[*] 旧快照的截图方式为 {target.screenshot_capture_mode or 'window'}，"
+                          f"当前为 {SCREENSHOT_CAPTURE_MODE}，重新保存基准: {target.url}")
+                    record_check_outcome(target, 'baseline', duration=budget.elapsed())
+                elif baseline_png is not None:
                     print("[DEBUG] 发现旧快照，准备进行对比...")
-                    last_img = load_screenshot(target.id)
-                    
-                    img_to_compare_current = current_img.copy()
-                    img_to_compare_last = last_img.copy()
-                    try:
-                        crop_box = json.loads(target.crop_area)
-                        if isinstance(crop_box, list) and len(crop_box) == 4 and crop_box[2] > crop_box[0] and crop_box[3] > crop_box[1]:
-                            print(f"[DEBUG] 应用裁剪区域进行对比: {crop_box}")
-                            img_to_compare_current = img_to_compare_current.crop(tuple(crop_box))
-                            img_to_compare_last = img_to_compare_last.crop(tuple(crop_box))
-                    except (json.JSONDecodeError, TypeError, ValueError, IndexError): pass
-
-                    if images_are_different(img_to_compare_last, img_to_compare_current, target.threshold):
+                    if crop_box:
+                        print(f"[DEBUG] 应用裁剪区域进行对比: {list(crop_box)}")
+                    result = image_pool.run(compare_with_baseline, baseline_png, capture['region'],
+                                            crop_box, target.threshold, target.compare_engine)
+
+                    if result:
                         print(f"[!!!] 检测到变化: {target.url}")
+                        record_check_outcome(target, 'changed', duration=budget.elapsed(), last_changed=datetime.now())
                         
-                        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        target.last_changed = datetime.now()
-                        
-                        subject = f"网页变化提醒: {target.name or target.url}"
-                        content = f"[{now_str}] 监控目标 '{target.name}' ({target.url}) 检测到页面发生视觉变化。"
-                        tg_message = f"<b>网页变化提醒</b>\n\n<b>目标:</b> {target.name}\n<b>网址:</b> {target.url}\n\n检测到页面有新变化！\n<b>时间:</b> {now_str}"
-                        
+                        # [MODIFIED] 交给通知分发器：按配置合并发送，并受各渠道限流约束
                         if notifications_config:
-                            send_email(subject, content, notifications_config)
-                            send_telegram_notification(tg_message, notifications_config)
-                            send_bark_notification(subject, content, notifications_config)
-                            send_pushplus_notification(subject, content, notifications_config)
-                    else: print(f"[-] 页面无变化: {target.url}")
-                else: print(f"[*] 首次截图，保存基准: {target.url}")
+                            notification_dispatcher.add_change(target, notifications_config)
+                        publish_target_event('target_changed', target)
+                    else:
+                        print(f"[-] 页面无变化: {target.url}")
+                        record_check_outcome(target, 'unchanged', duration=budget.elapsed())
+                else:
+                    print(f"[*] 首次截图，保存基准: {target.url}")
+                    record_check_outcome(target, 'baseline', duration=budget.elapsed())
 
                 # [MODIFIED] 使用辅助函数保存截图
-                save_screenshot(target.id, current_img)
+                # [MODIFIED] window 模式没有拼接，直接保存浏览器返回的原始 PNG，无需重新编码
+                save_screenshot(target.id, capture['png'] or raw_capture['strips'][0], capture['thumbnail'])
+                target.screenshot_capture_mode = SCREENSHOT_CAPTURE_MODE
                 
-                target.last_checked = datetime.now()
+                db.session.commit()
+            except CheckTimeout as e:
+                # [NEW] 预算耗尽：停止加载，回收浏览器（渲染进程可能已卡死），记录超时结果
+                print(f"[!!!] 检查超时: {target.url} - {e}")
+                if driver:
+                    stop_page_loading(driver)
+                    browser_pool.discard(driver)
+                    driver = None
+                db.session.rollback()
+                record_check_outcome(target, 'timeout', duration=budget.elapsed())
                 db.session.commit()
             except Exception as e:
                 print(f"[!!!] 处理 {target.url} 时发生严重异常!")
                 traceback.print_exc()
                 # 如果发生异常，销毁这个可能有问题的浏览器实例
                 if driver:
-                    try:
-                        driver.quit()
-                    except:
-                        pass
+                    browser_pool.discard(driver)
                     driver = None  # 标记已销毁，不再归还
+                db.session.rollback()
+                record_check_outcome(target, 'error', duration=budget.elapsed())
+                db.session.commit()
             finally:
                 # [MODIFIED] 归还浏览器到池中，而非销毁
                 if driver:
                     browser_pool.release(driver)
+                running_checks.discard(target.id)
+                publish_target_event('check_finished', target, outcome=bookkeeping_buffer.value(target, 'last_status'))
             print(f"--- 检查结束: {target.name or target.url} ---\n")
     finally:
         # [MODIFIED] 释放信号量
         browser_semaphore.release()
 
+def build_target_trigger(target):
+    """根据目标的调度配置创建 APScheduler 触发器，返回 (trigger, 描述)；配置无效时 trigger 为 None"""
+    if target.schedule_type == 'interval' and target.interval_minutes and target.interval_minutes > 0:
+        return IntervalTrigger(minutes=target.interval_minutes, timezone='Asia/Shanghai'), f"每 {target.interval_minutes} 分钟"
+    if target.schedule_type == 'cron' and target.cron_schedule:
+        return CronTrigger.from_crontab(target.cron_schedule, timezone='Asia/Shanghai'), f"Cron: '{target.cron_schedule}'"
+    return None, ""
+
 def sync_scheduler_from_db():
-    with app.app_context():
-        if scheduler.running: scheduler.remove_all_jobs()
+    # 未启用 scheduler 角色的进程（如纯 web 进程、CLI）不持有调度任务
+    if 'scheduler' not in active_roles: return
+    with flask_app.app_context():
+        # 只移除监控任务，保留浏览器池清理等维护任务
+        if scheduler.running:
+            for job in scheduler.get_jobs():
+                if job.id.startswith('target_'): job.remove()
         active_targets = MonitorTarget.query.filter_by(is_active=True).all()
         for target in active_targets:
             try:
                 job_id = f'target_{target.id}'
-                trigger = None
-                schedule_info = ""
-                
-                if target.schedule_type == 'interval' and target.interval_minutes and target.interval_minutes > 0:
-                    trigger = IntervalTrigger(minutes=target.interval_minutes, timezone='Asia/Shanghai')
-                    schedule_info = f"每 {target.interval_minutes} 分钟"
-                elif target.schedule_type == 'cron' and target.cron_schedule:
-                    trigger = CronTrigger.from_crontab(target.cron_schedule, timezone='Asia/Shanghai')
-                    schedule_info = f"Cron: '{target.cron_schedule}'"
+                trigger, schedule_info = build_target_trigger(target)
                 
                 if trigger:
                     scheduler.add_job(
@@ -647,8 +2231,202 @@ def sync_scheduler_from_db():
         if scheduler.running:
             print(f"[*] 任务同步完成，当前共有 {len(scheduler.get_jobs())} 个任务在调度中。")
 
+# --- [NEW] 容量规划 ---
+# 把所有启用目标的调度在一段时间内展开为触发时刻，结合每个目标实测的检查耗时，模拟浏览器槽位的占用与排队，
+# 提前发现浏览器并发上限不够用的情况（否则只能事后在日志里看到“系统繁忙，跳过任务”）。
+# 模拟规则与运行时保持一致：
+# - 同一目标上一次检查（含排队）尚未结束时，APScheduler 跳过本次触发（max_instances=1）；
+# - 没有空闲槽位时最多等待 BROWSER_WAIT_SECONDS 秒，超时则跳过；
+# - 槽位按先到先得分配。
+CAPACITY_DEFAULT_HOURS = 24
+CAPACITY_MAX_HOURS = 24 * 7
+# [MODIFIED] 页面请求在 Gunicorn 线程里同步计算，时长上限比命令行低，结果按相同参数缓存一段时间
+CAPACITY_WEB_MAX_HOURS = int(os.environ.get('CAPACITY_WEB_MAX_HOURS', 48))
+CAPACITY_CACHE_SECONDS = 60
+# 触发次数超过上限时，所有目标统一缩短模拟时长（而不是丢掉排在后面的目标）
+CAPACITY_MAX_RUNS = 200000
+# 没有实测耗时的目标使用的估算值（秒）：页面渲染固定等待 20 秒，再加上导航与截图
+DEFAULT_CHECK_SECONDS = 40
+
+def expand_fire_times(trigger, start, end, limit):
+    """列出触发器在 [start, end) 内的触发时刻，最多 limit 个"""
+    times = []
+    fire_time = trigger.get_next_fire_time(None, start)
+    while fire_time is not None and fire_time < end and len(times) < limit:
+        times.append(fire_time)
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time)
+    return times
+
+def estimate_check_seconds(target):
+    """估算目标单次检查占用浏览器的时间（秒），返回 (秒数, 是否为实测值)"""
+    budget = target.check_timeout or CHECK_TIMEOUT_SECONDS
+    if target.avg_check_seconds:
+        return min(target.avg_check_seconds, budget), True
+    return min(DEFAULT_CHECK_SECONDS, budget), False
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def simulate_slots(runs, slots, horizon_seconds, wait_limit=BROWSER_WAIT_SECONDS):
+    """
+    按时间顺序模拟一组检查在 slots 个浏览器槽位上的执行
+
+    Args:
+        runs: [(触发时刻偏移秒数, target_id, 检查耗时秒数)]，按时间排序
+        slots: 浏览器槽位数
+        horizon_seconds: 模拟时长，用于计算槽位利用率
+
+    Returns:
+        dict: 执行/跳过次数、排队等待（即检查迟到时间）统计、峰值并发、利用率以及按目标的明细
+    """
+    import heapq
+
+    free_at = [0.0] * slots  # 各槽位空闲的时刻（小顶堆）
+    busy_until = {}          # target_id -> 该目标本次任务（含排队）结束的时刻
+    per_target = {}
+    waits = []
+    skipped_busy = skipped_overlap = peak = 0
+    busy_seconds = 0.0
+    for at, target_id, duration in runs:
+        stats = per_target.setdefault(target_id, {'runs': 0, 'skipped': 0, 'max_wait': 0.0})
+        stats['runs'] += 1
+        if busy_until.get(target_id, 0.0) > at:
+            skipped_overlap += 1
+            stats['skipped'] += 1
+            continue
+        wait = max(0.0, free_at[0] - at)
+        if wait > wait_limit:
+            skipped_busy += 1
+            stats['skipped'] += 1
+            busy_until[target_id] = at + wait_limit
+            continue
+        started = at + wait
+        peak = max(peak, 1 + sum(1 for t in free_at if t > started))
+        heapq.heapreplace(free_at, started + duration)
+        busy_until[target_id] = started + duration
+        busy_seconds += min(duration, max(0.0, horizon_seconds - started))
+        waits.append(wait)
+        stats['max_wait'] = max(stats['max_wait'], wait)
+    return {
+        'slots': slots,
+        'runs': len(runs),
+        'started': len(waits),
+        'skipped_busy': skipped_busy,
+        'skipped_overlap': skipped_overlap,
+        'late_runs': sum(1 for w in waits if w > 0),
+        'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+        'p95_wait': percentile(waits, 0.95),
+        'max_wait': max(waits, default=0.0),
+        'peak_concurrency': peak,
+        'utilization': busy_seconds / (slots * horizon_seconds) if horizon_seconds else 0.0,
+        'per_target': per_target,
+    }
+
+def plan_capacity(targets, slots=None, hours=CAPACITY_DEFAULT_HOURS, start=None):
+    """
+    展开目标调度并模拟浏览器并发
+
+    Args:
+        targets: 参与规划的 MonitorTarget 列表（通常为所有启用的目标）
+        slots: 要评估的浏览器并发数，默认使用当前的并发上限
+        hours: 模拟的时间范围（小时）
+        start: 模拟起点，默认为当前时间
+
+    Returns:
+        dict: current（按 slots 模拟的结果）、peak_demand（槽位不受限时的峰值并发，即零迟到所需槽位数）、
+              slots_needed（不发生“系统繁忙”跳过所需的最少槽位数）以及每个目标的明细；
+              触发次数超过 CAPACITY_MAX_RUNS 时 truncated 为真，end 提前到截断时刻
+    """
+    import heapq
+    from datetime import timedelta
+    from itertools import repeat
+
+    slots = slots or browser_semaphore.limit
+    start = start or datetime.now(scheduler.timezone)
+    end = start + timedelta(hours=hours)
+    streams, rows, invalid = [], [], []
+    # 相同调度的目标触发时刻相同（间隔触发器在同步任务时同时开始计时），只展开一次；
+    # 单个调度最多需要 CAPACITY_MAX_RUNS + 1 个时刻即可确定截断位置
+    fire_times_by_schedule = {}
+    for target in targets:
+        name = target.name or target.url
+        try:
+            trigger, schedule_info = build_target_trigger(target)
+        except ValueError as e:
+            # 表单不校验 Cron 表达式，格式或取值错误要到构建触发器时才会暴露
+            invalid.append(f"{name}（{e}）")
+            continue
+        if trigger is None:
+            invalid.append(name)
+            continue
+        duration, measured = estimate_check_seconds(target)
+        if schedule_info not in fire_times_by_schedule:
+            fire_times_by_schedule[schedule_info] = expand_fire_times(trigger, start, end, CAPACITY_MAX_RUNS + 1)
+        streams.append(zip(fire_times_by_schedule[schedule_info], repeat(target.id), repeat(duration)))
+        rows.append({'id': target.id, 'name': name, 'schedule': schedule_info,
+                     'duration': duration, 'measured': measured})
+
+    # 按时间归并所有目标的触发时刻；超过上限时在第 CAPACITY_MAX_RUNS + 1 次触发处整体截断，
+    # 截断时刻之前每个目标的触发都完整保留，同一时刻的触发要么全部计入要么全部丢弃
+    runs, truncated = [], False
+    for fire_time, target_id, duration in heapq.merge(*streams, key=lambda run: run[0]):
+        if len(runs) >= CAPACITY_MAX_RUNS:
+            truncated, end = True, fire_time
+            break
+        runs.append(((fire_time - start).total_seconds(), target_id, duration))
+    if truncated:
+        cutoff = (end - start).total_seconds()
+        while runs and runs[-1][0] >= cutoff:
+            runs.pop()
+    horizon_seconds = (end - start).total_seconds()
+    runs.sort()
+
+    current = simulate_slots(runs, slots, horizon_seconds)
+    # 每个目标同一时刻至多一个实例，因此槽位数等于目标数时相当于不受限
+    unlimited = simulate_slots(runs, max(1, len(rows)), horizon_seconds)
+    peak_demand = unlimited['peak_concurrency']
+    # 跳过次数随槽位增加单调不增，二分查找不发生“系统繁忙”跳过的最少槽位数
+    low, high = 1, max(1, peak_demand)
+    while low < high:
+        middle = (low + high) // 2
+        if simulate_slots(runs, middle, horizon_seconds)['skipped_busy'] == 0:
+            high = middle
+        else:
+            low = middle + 1
+
+    for row in rows:
+        row.update(current['per_target'].get(row['id'], {'runs': 0, 'skipped': 0, 'max_wait': 0.0}))
+    return {
+        'start': start, 'end': end, 'hours': hours, 'simulated_hours': horizon_seconds / 3600, 'slots': slots,
+        'runs_total': len(runs), 'truncated': truncated, 'invalid': invalid,
+        'current': current, 'peak_demand': peak_demand, 'slots_needed': low,
+        'targets': sorted(rows, key=lambda row: (-row['skipped'], -row['max_wait'])),
+    }
+
+capacity_cache = {}
+capacity_cache_lock = Lock()
+
+def cached_capacity_plan(targets, slots, hours):
+    """页面使用的容量规划：相同的参数与调度配置在 CAPACITY_CACHE_SECONDS 秒内复用上次的结果"""
+    key = (slots, hours, tuple((t.id, t.schedule_type, t.interval_minutes, t.cron_schedule, t.check_timeout)
+                               for t in targets))
+    now = time.monotonic()
+    with capacity_cache_lock:
+        cached = capacity_cache.get(key)
+        if cached and now < cached[0]:
+            return cached[1]
+    plan = plan_capacity(targets, slots, hours)
+    with capacity_cache_lock:
+        # 只保留最近一次的结果，避免不同参数的请求把缓存撑大
+        capacity_cache.clear()
+        capacity_cache[key] = (now + CAPACITY_CACHE_SECONDS, plan)
+    return plan
+
 # --- 5. Web 路由 ---
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 @limiter.limit("5 per minute", error_message="登录尝试次数过多，请稍后再试")
 def login():
     if request.method == 'POST':
@@ -659,7 +2437,7 @@ def login():
             is_valid = check_password_hash(user.password_hash, request.form['password'])
             if is_valid:
                 session['user_id'], session['username'] = user.id, user.username
-                return redirect(url_for('dashboard'))
+                return redirect(url_for('main.dashboard'))
         else:
             # 假定此处使用的是 werkzeug 默认的 pbkdf2:sha256
             check_password_hash('pbkdf2:sha256:600000$dummy$dummy', request.form['password'])
@@ -667,12 +2445,12 @@ def login():
         flash('无效的用户名或密码', 'danger')
     return render_template('login.html')
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/screenshots/<path:filename>')
+@main.route('/screenshots/<path:filename>')
 def serve_screenshot(filename):
     if 'user_id' not in session: 
         return "Unauthorized", 401
@@ -684,31 +2462,42 @@ def serve_screenshot(filename):
         if not target:
             return "File not found", 404
         
+        crop_box = json.loads(target.crop_area or '[]')
+        crop_box = crop_box if isinstance(crop_box, list) and len(crop_box) == 4 else None
+        if request.args.get('thumb') == '1':
+            # [NEW] 缩略图在检查时生成并保存，这里直接返回；旧截图或修改监控区域后缺失时生成一次并保存
+            thumbnail = load_thumbnail(target_id)
+            if thumbnail is None:
+                png = load_screenshot(target_id)
+                if png is None:
+                    return "File not found", 404
+                thumbnail = image_pool.run(render_screenshot, png, crop_box, True)
+                save_thumbnail(target_id, thumbnail)
+                db.session.commit()
+            # 按内容生成 ETag，浏览器每次向服务器确认，截图未更新时返回 304
+            return send_file(io.BytesIO(thumbnail), mimetype='image/png',
+                             etag=hashlib.md5(thumbnail).hexdigest())
+
         # [MODIFIED] 使用辅助函数加载截图
-        image = load_screenshot(target_id)
-        if not image:
+        png = load_screenshot(target_id)
+        if png is None:
             return "File not found", 404
         
-        # 绘制裁剪区域红框
-        crop_box = json.loads(target.crop_area or '[]')
-        if isinstance(crop_box, list) and len(crop_box) == 4:
-            draw = ImageDraw.Draw(image)
-            draw.rectangle(crop_box, outline="red", width=5)
-        
-        img_io = io.BytesIO()
-        image.save(img_io, 'PNG')
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/png')
+        # 绘制裁剪区域红框；无需处理时直接返回原始字节，不做解码
+        if crop_box:
+            png = image_pool.run(render_screenshot, png, crop_box, False)
+        return send_file(io.BytesIO(png), mimetype='image/png')
     except (ValueError, json.JSONDecodeError, IndexError) as e:
         print(f"[WARN] 处理截图请求时出错: {e}")
         return "Error processing screenshot", 500
 
-@app.route('/')
+@main.route('/')
 def dashboard():
-    if 'user_id' not in session: return redirect(url_for('login'))
-    targets = MonitorTarget.query.order_by(MonitorTarget.id.desc()).all()
+    if 'user_id' not in session: return redirect(url_for('main.login'))
+    targets = bookkeeping_buffer.apply(MonitorTarget.query.order_by(MonitorTarget.id.desc()).all())
     notifications = NotificationSettings.query.first()
-    return render_template('dashboard.html', targets=targets, notifications=notifications, now=datetime.now)
+    return render_template('dashboard.html', targets=targets, notifications=notifications,
+                           comparators=COMPARATORS, default_engine=DEFAULT_COMPARE_ENGINE)
 
 def process_schedule_form(form_data, target_obj):
     target_obj.schedule_type = form_data.get('schedule_type')
@@ -727,14 +2516,35 @@ def process_schedule_form(form_data, target_obj):
         target_obj.interval_minutes = None
     return target_obj
 
-@app.route('/target/add', methods=['POST'])
+def parse_check_timeout(value):
+    """表单中的检查超时（秒），留空或非法时返回 None，表示使用默认值"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+def parse_compare_engine(value):
+    return value if value in COMPARATORS else DEFAULT_COMPARE_ENGINE
+
+def parse_threshold(value, engine):
+    """表单中的差异阈值（可为小数），留空或非法时使用引擎的默认阈值"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default_threshold(engine)
+    return value if value >= 0 and math.isfinite(value) else default_threshold(engine)
+
+@main.route('/target/add', methods=['POST'])
 def add_target():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('main.login'))
     new_target = MonitorTarget(
         name=request.form.get('name'), url=request.form.get('url'),
         screenshot_width=int(request.form.get('screenshot_width', 1920)),
         screenshot_max_height=int(request.form.get('screenshot_max_height', 15000)),
-        threshold=int(request.form.get('threshold', 5)),
+        threshold=parse_threshold(request.form.get('threshold'), parse_compare_engine(request.form.get('compare_engine'))),
+        check_timeout=parse_check_timeout(request.form.get('check_timeout')),
+        compare_engine=parse_compare_engine(request.form.get('compare_engine')),
         crop_area=request.form.get('crop_area', '[]'),
         login_method=request.form.get('login_method'),
         cookies=request.form.get('cookies'),
@@ -749,18 +2559,28 @@ def add_target():
     db.session.add(new_target)
     db.session.commit()
     sync_scheduler_from_db()
+    invalidate_summary()
     flash('监控目标已成功添加！', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
 
-@app.route('/target/edit', methods=['POST'])
+@main.route('/target/edit', methods=['POST'])
 def edit_target():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('main.login'))
     target = MonitorTarget.query.get_or_404(request.form.get('target_id'))
     target.name = request.form.get('name')
     target.url = request.form.get('url')
     target.screenshot_width = int(request.form.get('screenshot_width'))
     target.screenshot_max_height = int(request.form.get('screenshot_max_height'))
-    target.threshold = int(request.form.get('threshold'))
+    previous_engine = target.compare_engine or DEFAULT_COMPARE_ENGINE
+    target.compare_engine = parse_compare_engine(request.form.get('compare_engine'))
+    target.threshold = parse_threshold(request.form.get('threshold'), target.compare_engine)
+    # 切换引擎但阈值仍是旧引擎的默认值时，改用新引擎的默认值（各引擎的阈值单位不同）
+    if target.compare_engine != previous_engine and target.threshold == default_threshold(previous_engine):
+        target.threshold = default_threshold(target.compare_engine)
+    target.check_timeout = parse_check_timeout(request.form.get('check_timeout'))
+    if request.form.get('crop_area') != target.crop_area:
+        # 缩略图上画有监控区域，区域变化后清除，下次访问时按新区域重新生成
+        save_thumbnail(target.id, None)
     target.crop_area = request.form.get('crop_area')
     target.login_method = request.form.get('login_method')
     target.cookies = request.form.get('cookies')
@@ -773,39 +2593,125 @@ def edit_target():
     target = process_schedule_form(request.form, target)
     db.session.commit()
     sync_scheduler_from_db()
+    invalidate_summary()
     flash('监控目标已成功更新！', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
 
-@app.route('/target/delete/<int:target_id>', methods=['POST'])
+@main.route('/target/delete/<int:target_id>', methods=['POST'])
 def delete_target(target_id):
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('main.login'))
     target = MonitorTarget.query.get_or_404(target_id)
     db.session.delete(target)
     db.session.commit()
     sync_scheduler_from_db()
+    invalidate_summary()
     flash('监控目标已成功删除！', 'info')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
 
-@app.route('/target/toggle/<int:target_id>', methods=['POST'])
+@main.route('/target/toggle/<int:target_id>', methods=['POST'])
 def toggle_target(target_id):
     if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
     target = MonitorTarget.query.get_or_404(target_id)
     target.is_active = not target.is_active
     db.session.commit()
     sync_scheduler_from_db()
+    invalidate_summary()
     return jsonify({'status': 'success', 'is_active': target.is_active})
 
-@app.route('/target/execute/<int:target_id>', methods=['POST'])
+@main.route('/target/execute/<int:target_id>', methods=['POST'])
 def execute_manual_check(target_id):
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('main.login'))
     target = MonitorTarget.query.get_or_404(target_id)
+    if 'worker' not in active_roles:
+        flash('当前进程未启用 worker 角色，无法在此执行检查。', 'warning')
+        return redirect(url_for('main.dashboard'))
     execute_target_check(target.id)
     flash(f"已手动为 '{target.name or target.url}' 触发了一次监控检查。", 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
+
+@main.route('/capacity')
+def capacity():
+    if 'user_id' not in session: return redirect(url_for('main.login'))
+    hours = min(max(request.args.get('hours', CAPACITY_DEFAULT_HOURS, type=int), 1), CAPACITY_WEB_MAX_HOURS)
+    slots = request.args.get('slots', type=int)
+    slots = max(1, slots) if slots else browser_semaphore.limit
+    plan = cached_capacity_plan(MonitorTarget.query.filter_by(is_active=True).all(), slots, hours)
+    return render_template('capacity.html', plan=plan, max_hours=CAPACITY_WEB_MAX_HOURS,
+                           wait_limit=BROWSER_WAIT_SECONDS, default_seconds=DEFAULT_CHECK_SECONDS)
+
+@main.route('/api/targets')
+@limiter.exempt
+def target_status():
+    """分页的目标状态列表与缓存的摘要，供仪表盘轮询或 SSE 重连后对齐状态"""
+    if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 50, type=int)
+    pagination = MonitorTarget.query.order_by(MonitorTarget.id.desc()).paginate(
+        page=page, per_page=per_page, max_per_page=200, error_out=False)
+    return jsonify({
+        'targets': [target_to_dict(target) for target in pagination.items],
+        'page': pagination.page,
+        'per_page': pagination.per_page,
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'summary': target_summary(),
+    })
+
+@main.route('/api/events')
+@limiter.exempt
+def event_stream():
+    """SSE：推送 check_started / check_finished / target_changed 事件"""
+    if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    q = event_bus.subscribe()
+    if q is None:
+        # 连接数已满，前端退回到轮询 /api/targets
+        return jsonify({'status': 'error', 'message': 'Too many event streams'}), 503
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            deadline = time.monotonic() + SSE_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    event = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            event_bus.unsubscribe(q)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@main.route('/api/browsers')
+def browser_stats():
+    """浏览器进程数量与内存占用"""
+    if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    return jsonify(dict(browser_supervisor.stats(browser_pool), autoscale=browser_autoscaler.stats()))
+
+@main.route('/api/checks')
+def check_stats():
+    """检查结果统计（含各目标的超时次数）"""
+    if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    with check_stats_lock:
+        return jsonify({
+            'default_timeout_seconds': CHECK_TIMEOUT_SECONDS,
+            'outcomes': dict(check_outcome_counts),
+            'timeouts_by_target': dict(timeout_counts_by_target),
+            'bookkeeping': bookkeeping_buffer.stats(),
+            'image_pool': image_pool.stats(),
+        })
+
+@main.route('/api/notifications')
+def notification_stats():
+    """通知合并与限流状态"""
+    if 'user_id' not in session: return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    return jsonify(notification_dispatcher.stats())
 
-@app.route('/notifications/save', methods=['POST'])
+@main.route('/notifications/save', methods=['POST'])
 def save_notifications():
-    if 'user_id' not in session: return redirect(url_for('login'))
+    if 'user_id' not in session: return redirect(url_for('main.login'))
     settings = NotificationSettings.query.first()
     if not settings: settings = NotificationSettings()
     settings.telegram_bot_token = request.form.get('telegram_bot_token')
@@ -819,16 +2725,21 @@ def save_notifications():
     settings.to_email = request.form.get('to_email')
     settings.bark_url = request.form.get('bark_url')
     settings.pushplus_token = request.form.get('pushplus_token')
+    try:
+        settings.digest_window_seconds = max(0, int(request.form.get('digest_window_seconds') or 0))
+    except ValueError:
+        settings.digest_window_seconds = 0
     db.session.add(settings)
     db.session.commit()
     flash('通知设置已成功保存！', 'success')
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
 
 
 # --- 6. 启动与初始化 ---
-@app.cli.command("init-db")
+@main.cli.command("init-db")
 def init_db():
     db.create_all()
+    ensure_schema_columns()
     admin_user = os.environ.get('ADMIN_USER', 'admin')
     admin_pass = os.environ.get('ADMIN_PASSWORD', 'admin')
     user = User.query.filter_by(username=admin_user).first()
@@ -841,17 +2752,260 @@ def init_db():
     db.session.commit()
     print(f"数据库初始化完成。管理员 '{admin_user}' 已配置。")
 
-with app.app_context():
-    db.create_all()
-    if not NotificationSettings.query.first():
-        db.session.add(NotificationSettings())
-        db.session.commit()
-    
+def ensure_schema_columns():
+    """为已存在的数据表补齐新增的列（db.create_all 只建新表，不会修改已有表）"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            print(f"[DB] 已为表 {table.name} 新增列 {column.name} ({column_type})")
+        widen_float_columns(inspector, table)
+
+def widen_float_columns(inspector, table):
+    """把旧版本中为整数、现在为浮点的列（如 threshold）改为浮点类型；SQLite 按值存储类型，无需修改"""
+    dialect = db.engine.dialect.name
+    if dialect not in ('mysql', 'mariadb', 'postgresql'):
+        return
+    existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if not isinstance(column.type, db.Float) or not isinstance(existing.get(column.name), db.Integer):
+            continue
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        if dialect == 'postgresql':
+            statement = f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {column_type}'
+        else:
+            statement = f'ALTER TABLE {table.name} MODIFY {column.name} {column_type}'
+        with db.engine.begin() as conn:
+            conn.execute(db.text(statement))
+        print(f"[DB] 已将表 {table.name} 的列 {column.name} 改为 {column_type}")
+
+@main.cli.command("bench-compare")
+@click.option('--width', default=1920, show_default=True, help='合成截图宽度')
+@click.option('--height', default=4000, show_default=True, help='合成截图高度')
+@click.option('--runs', default=5, show_default=True, help='每个引擎的重复次数')
+def bench_compare(width, height, runs):
+    """用合成截图测量各对比引擎的耗时"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    # 合成“网页”：白底 + 随机色块，再在中部改动一块区域
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    for _ in range(height // 20):
+        x, y = rng.integers(0, width - 200), rng.integers(0, height - 60)
+        page[y:y + rng.integers(10, 60), x:x + rng.integers(50, 200)] = rng.integers(0, 255, 3)
+    changed = page.copy()
+    changed[height // 2:height // 2 + 150, width // 4:width // 2] = (30, 30, 30)
+    img1, img2 = Image.fromarray(page), Image.fromarray(changed)
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        last, current = ComparisonInput(img1), ComparisonInput(img2)
+    prepare_ms = (time.perf_counter() - started) / runs * 1000 / 2
+    print(f"截图 {width}x{height}，缩略数组 {current.page.shape[1]}x{current.page.shape[0]}，每次 {runs} 轮取平均")
+    print(f"{'准备(灰度+缩小)':<20}{prepare_ms:>10.2f} ms/张")
+    for name, (label, unit, threshold, func) in COMPARATORS.items():
+        started = time.perf_counter()
+        for _ in range(runs):
+            score = func(last.region, current.region)
+        elapsed_ms = (time.perf_counter() - started) / runs * 1000
+        verdict = '变化' if score > threshold else '未检出'
+        print(f"{name:<20}{elapsed_ms:>10.2f} ms   {unit}: {score:.2f} (默认阈值 {threshold}: {verdict})")
+
+@main.cli.command("plan-capacity")
+@click.option('--hours', default=CAPACITY_DEFAULT_HOURS, show_default=True,
+              type=click.IntRange(1, CAPACITY_MAX_HOURS), help=f'模拟的时间范围（小时，最多 {CAPACITY_MAX_HOURS}）')
+@click.option('--slots', type=int, default=None, help='要评估的浏览器并发数，默认为当前的并发上限')
+def plan_capacity_command(hours, slots):
+    """模拟启用目标的调度负载，评估浏览器并发数是否足够"""
+    plan = plan_capacity(MonitorTarget.query.filter_by(is_active=True).all(), slots, hours)
+    current = plan['current']
+    print(f"模拟区间: {plan['start']:%Y-%m-%d %H:%M} ~ {plan['end']:%Y-%m-%d %H:%M} ({plan['hours']} 小时)，"
+          f"共 {plan['runs_total']} 次触发")
+    if plan['truncated']:
+        print(f"[!] 触发次数超过 {CAPACITY_MAX_RUNS}，模拟时长已缩短为 {plan['simulated_hours']:.1f} 小时")
+    for name in plan['invalid']:
+        print(f"[!] 调度配置无效，未计入: {name}")
+    print(f"峰值并发需求: {plan['peak_demand']}  |  避免跳过所需并发: {plan['slots_needed']}")
+    print(f"按并发 {plan['slots']} 模拟: 执行 {current['started']}，因繁忙跳过 {current['skipped_busy']}，"
+          f"因上次未结束跳过 {current['skipped_overlap']}，迟到 {current['late_runs']} 次")
+    print(f"迟到时间: 平均 {current['mean_wait']:.1f}s, P95 {current['p95_wait']:.1f}s, 最大 {current['max_wait']:.1f}s"
+          f"  |  槽位利用率 {current['utilization']:.0%}")
+    print(f"\n{'ID':>4}  {'耗时(s)':>8}  {'触发':>6}  {'跳过':>6}  {'最大迟到(s)':>10}  目标 / 调度")
+    for row in plan['targets']:
+        duration = f"{row['duration']:.0f}{'' if row['measured'] else '*'}"
+        print(f"{row['id']:>4}  {duration:>8}  {row['runs']:>6}  {row['skipped']:>6}  {row['max_wait']:>10.1f}  "
+              f"{row['name']} / {row['schedule']}")
+    if not all(row['measured'] for row in plan['targets']):
+        print(f"\n* 尚无实测耗时，按 {DEFAULT_CHECK_SECONDS} 秒估算")
+
+# --- [NEW] SQLite 生产模式 ---
+# 多个 Gunicorn 线程与调度线程同时写 monitoring.db 时，默认的回滚日志模式会频繁出现 "database is locked"。
+# WAL 模式下读写互不阻塞；busy_timeout 让写入在锁冲突时等待而不是立即失败；
+# WAL 下 synchronous=NORMAL 仍然保证数据库一致性，只是断电时可能丢失最后几次提交。
+SQLITE_TUNED = os.environ.get('SQLITE_TUNED', 'true').lower() == 'true'
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """engine connect 事件：为每个新的 SQLite 连接设置 WAL、busy_timeout 与 synchronous"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.close()
+
+def configure_sqlite_engine():
+    """在 SQLite 引擎上注册连接事件（需在应用上下文中调用）"""
+    from sqlalchemy import event
+
+    if db.engine.dialect.name != 'sqlite' or event.contains(db.engine, 'connect', apply_sqlite_pragmas):
+        return
+    event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+    # 事件注册前可能已有连接进入连接池，丢弃它们以确保所有连接都应用了设置
+    db.engine.dispose()
+    print(f"[DB] SQLite 已启用 WAL 模式 (busy_timeout={SQLITE_BUSY_TIMEOUT_MS}ms, synchronous={SQLITE_SYNCHRONOUS})")
+
+def parse_roles(value):
+    """解析逗号分隔的进程角色字符串，返回角色集合"""
+    roles = {role.strip().lower() for role in (value or '').split(',') if role.strip()}
+    unknown = roles - set(APP_ROLES)
+    if unknown:
+        raise ValueError(f"未知的进程角色: {', '.join(sorted(unknown))} (可选: {', '.join(APP_ROLES)})")
+    if 'scheduler' in roles:
+        # 调度任务在本进程的线程池中执行，必然需要启动浏览器
+        roles.add('worker')
+    return roles or {'cli'}
+
+def create_app(roles=None):
+    """
+    应用工厂：创建并按角色初始化 Flask 应用
+
+    Args:
+        roles: 逗号分隔的角色字符串，例如 'web,scheduler'。
+               未指定时为 'cli'，只完成配置，不建表、不启动调度器。
+
+    Returns:
+        Flask: 应用实例
+    """
+    global flask_app
+    factory_started = time.perf_counter()
+    roles = parse_roles(roles)
+
+    app = Flask(__name__)
+
+    # 确保 instance 和 screenshots 文件夹存在
+    os.makedirs(app.instance_path, exist_ok=True)
+    os.makedirs(SCREENSHOT_DIR, exist_ok=True)
+
+    # 配置
+    # 安全修复: 如果没有设置环境变量SECRET_KEY，则自动生成一个安全的随机字符，不再使用固定的弱前缀
+    secret_key = os.environ.get('SECRET_KEY')
+    if not secret_key:
+        secret_key = os.urandom(24).hex()
+        if 'cli' not in roles:
+            print("\n" + "="*60)
+            print("⚠️  [安全警告] 未设置 SECRET_KEY 环境变量！")
+            print("   系统已自动生成一个临时的随机密钥。每次重启此密钥都会改变，")
+            print("   这会导致重启后所有已登录的 Session 失效。")
+            print("   建议: 在部署环境设置固定且强随机的 SECRET_KEY 环境变量。")
+            print("="*60 + "\n")
+    app.config['SECRET_KEY'] = secret_key
+
+    # --- 全局安全配置 ---
+    # 开启 SESSION_COOKIE_HTTPONLY 以防 XSS 窃取 Cookie
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    # 开启 SameSite 限制，减少 CSRF 和跨站跟踪风险
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    # 如果明确配置了 HTTPS，可以开启 SECURE (如果是反向代理且未配置信任头，开启可能导致 session 丢失)
+    if os.environ.get('REQUIRE_HTTPS', 'false').lower() == 'true':
+        app.config['SESSION_COOKIE_SECURE'] = True
+
+    # --- 数据库配置（支持 SQLite 和 MariaDB/MySQL）---
+    # 优先使用环境变量 DATABASE_URL，未设置则使用 SQLite
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+        print(f"[DB] 使用外部数据库: {database_url.split('@')[-1] if '@' in database_url else database_url}")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'monitoring.db')
+        print("[DB] 使用本地 SQLite 数据库")
+    print(f"[截图存储] {'数据库模式' if USE_DB_SCREENSHOT else '文件系统模式'}")
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # [NEW] 解决云环境数据库连接断开问题 (MySQL server has gone away)
+    # pool_pre_ping: 每次使用连接前检测是否存活，断开则自动重连
+    # pool_recycle: 280秒主动刷新连接，避开云防火墙300秒杀连接的阈值
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+    }
+
+    # --- 绑定扩展（CSRF 保护、频率限制、数据库）---
+    csrf.init_app(app)
+    limiter.init_app(app)
+    db.init_app(app)
+    app.register_blueprint(main)
+
+    if not database_url and SQLITE_TUNED:
+        with app.app_context():
+            configure_sqlite_engine()
+
+    app.config['APP_ROLES'] = sorted(roles)
+    active_roles.clear()
+    active_roles.update(roles)
+    flask_app = app
+
+    if roles & {'web', 'scheduler'}:
+        with app.app_context():
+            db.create_all()
+            ensure_schema_columns()
+            if not NotificationSettings.query.first():
+                db.session.add(NotificationSettings())
+                db.session.commit()
+
+    if roles & {'web', 'worker'}:
+        # [NEW] 图像处理进程池在首次使用时启动，退出时不等待未完成的任务
+        import atexit
+        atexit.register(image_pool.shutdown)
+
+    if 'worker' in roles:
+        # [NEW] 启动时先回收上一次运行遗留的浏览器进程，并接管 SIGTERM 以便优雅退出
+        # 进程退出前把缓冲中的检查记录写回数据库（atexit 后注册先执行，因此先于浏览器排空注册，确保最后写回）
+        import atexit
+        atexit.register(bookkeeping_buffer.flush_at_exit)
+        browser_pool.reap_orphans()
+        browser_supervisor.install_signal_handlers(browser_pool)
+        # [NEW] 按容器内存计算浏览器并发上限
+        browser_autoscaler.initialize()
+
+    if 'scheduler' in roles:
+        start_scheduler(app)
+
+    # [NEW] 记录冷启动耗时：模块导入（含第三方依赖）+ 工厂初始化
+    now = time.perf_counter()
+    app.config['STARTUP_SECONDS'] = round(now - MODULE_LOAD_STARTED, 3)
+    print(f"[STARTUP] 角色: {','.join(sorted(roles))} | "
+          f"模块导入 {(factory_started - MODULE_LOAD_STARTED) * 1000:.0f} ms, "
+          f"应用初始化 {(now - factory_started) * 1000:.0f} ms, "
+          f"合计 {app.config['STARTUP_SECONDS'] * 1000:.0f} ms")
+    return app
+
+def start_scheduler(app):
+    """启动后台调度器，注册维护任务并从数据库同步监控任务"""
     if not scheduler.running:
         scheduler.start()
         print("[SCHEDULER] 后台调度器已成功启动。")
-    
-    # [NEW] 添加浏览器池清理任务，每 5 分钟检查一次
+
+    # [NEW] 添加浏览器池清理任务，每 5 分钟检查一次（同时回收孤儿进程、回收超出内存上限的实例）
     if not scheduler.get_job('browser_pool_cleanup'):
         scheduler.add_job(
             id='browser_pool_cleanup',
@@ -859,10 +3013,20 @@ with app.app_context():
             trigger=IntervalTrigger(minutes=5, timezone='Asia/Shanghai')
         )
         print("[BrowserPool] 已添加浏览器池空闲清理任务 (每5分钟)")
-    
+
+    # [NEW] 按内存压力与排队情况调整浏览器并发上限
+    if browser_autoscaler.enabled and not scheduler.get_job('browser_autoscale'):
+        scheduler.add_job(
+            id='browser_autoscale',
+            func=browser_autoscaler.tick,
+            trigger=IntervalTrigger(seconds=AUTOSCALE_INTERVAL_SECONDS, timezone='Asia/Shanghai')
+        )
+        print(f"[Autoscale] 已添加浏览器并发自动调整任务 (每{AUTOSCALE_INTERVAL_SECONDS}秒)")
+
     print("[SCHEDULER] 应用启动，正在从数据库同步所有任务...")
     sync_scheduler_from_db()
 
 if __name__ == '__main__':
     # 注意：直接运行此文件仅用于本地开发调试，生产环境请使用 Gunicorn
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # debug 模式下关闭重载器，避免父子进程各启动一个调度器
+    create_app(os.environ.get('APP_ROLES', 'web,scheduler')).run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
@@ -23,4 +23,5 @@ echo "--- 启动 Gunicorn Web 服务器，监听端口 5000 ---"
 # [MODIFIED] 使用单 worker 模式，确保 APScheduler 后台调度器正常运行
 # 多 worker 模式会导致调度器在不同进程中重复/丢失任务
 # 使用更多线程 (8) 来补偿单 worker 的并发能力
-exec gunicorn --workers 1 --threads 8 --timeout 120 --bind 0.0.0.0:${PORT:-5000} app:app
+# [MODIFIED] 通过应用工厂启动，APP_ROLES 决定本进程承担的角色（默认 Web + 调度）
+exec gunicorn --workers 1 --threads 8 --timeout 120 --bind 0.0.0.0:${PORT:-5000} "app:create_app('${APP_ROLES:-web,scheduler}')"
@@ -0,0 +1,37 @@
+import app
+
+MB = 2**20
+
+class FakePool:
+    def __init__(self):
+        self.trimmed = 0
+
+    def trim(self):
+        self.trimmed += 1
+
+def memory_status(available_mb, pressure=None, limit_mb=4096):
+    return {'limit': limit_mb * MB, 'used': (limit_mb - available_mb) * MB,
+            'available': available_mb * MB, 'pressure': pressure}
+
+def test_autoscale_tick():
+    print("--- 1. 自动调整：内存不足时缩容，排队且内存充足时扩容 ---")
+    limit = app.ConcurrencyLimit(3)
+    pool = FakePool()
+    scaler = app.BrowserAutoscaler(limit, pool, app.BrowserSupervisor())
+    scaler.enabled = True
+    statuses = [memory_status(100), memory_status(3000, pressure=0.0)]
+    read_memory_status = app.read_memory_status
+    app.read_memory_status = lambda: statuses.pop(0)
+    try:
+        # 剩余内存不足半个浏览器：3 -> 2
+        scaler.tick()
+        # 有检查因等待超时被跳过，内存充足：2 -> 3
+        limit.timeouts += 1
+        scaler.tick()
+    finally:
+        app.read_memory_status = read_memory_status
+    assert [(entry['from'], entry['to']) for entry in scaler.history] == [(3, 2), (2, 3)], list(scaler.history)
+    assert limit.limit == 3 and pool.trimmed == 1
+
+if __name__ == "__main__":
+    test_autoscale_tick()
@@ -0,0 +1,31 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+import app
+
+def sparse_text_page(seed=0, glyphs=1200):
+    rng = np.random.default_rng(seed)
+    img = Image.new('RGB', (1920, 4000), 'white')
+    draw = ImageDraw.Draw(img)
+    for _ in range(glyphs):
+        draw.text((int(rng.integers(0, 1900)), int(rng.integers(0, 3990))), "abc", fill='black')
+    return img
+
+def test_blank_page_uses_full_resolution():
+    print("--- 1. 空白页检测使用原始分辨率 ---")
+    img = sparse_text_page()
+    data = app.ComparisonInput(img)
+    pixels = np.asarray(img.convert('L'))
+    # 与整页灰度数组的统计一致，而不是缩略数组
+    assert abs(data.std_dev - pixels.std()) < 1e-6 and abs(data.mean_brightness - pixels.mean()) < 1e-6
+    assert data.page.std() < data.std_dev
+    assert not app.is_blank_page(data)
+
+def test_blank_page_verdicts():
+    print("--- 2. 白屏、黑屏与单色页面 ---")
+    for color in ('white', 'black', (128, 128, 128)):
+        assert app.is_blank_page(app.ComparisonInput(Image.new('RGB', (1920, 2000), color))), color
+
+if __name__ == "__main__":
+    test_blank_page_uses_full_resolution()
+    test_blank_page_verdicts()
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+import app
+
+TZ = ZoneInfo('Asia/Shanghai')
+START = datetime(2024, 1, 1, tzinfo=TZ)
+
+def offsets(times):
+    return [(t - START).total_seconds() for t in times]
+
+def test_expand_fire_times():
+    print("--- 1. expand_fire_times ---")
+    cases = [
+        # (说明, 触发器, 时长(秒), limit, 期望的触发偏移秒数)
+        ("每 5 分钟, 15 分钟内", IntervalTrigger(minutes=5, start_date=START, timezone=TZ), 900, 100, [0, 300, 600]),
+        ("区间右端不包含", IntervalTrigger(minutes=5, start_date=START, timezone=TZ), 600, 100, [0, 300]),
+        ("limit 截断", IntervalTrigger(minutes=1, start_date=START, timezone=TZ), 3600, 3, [0, 60, 120]),
+        ("整点 cron", CronTrigger.from_crontab('0 * * * *', timezone=TZ), 3 * 3600, 100, [0, 3600, 7200]),
+        ("区间内不触发", CronTrigger.from_crontab('30 12 * * *', timezone=TZ), 3600, 100, []),
+    ]
+    for name, trigger, seconds, limit, expected in cases:
+        times = app.expand_fire_times(trigger, START, START + timedelta(seconds=seconds), limit)
+        assert offsets(times) == expected, (name, offsets(times))
+
+def test_simulate_slots():
+    print("--- 2. simulate_slots ---")
+    cases = [
+        # (说明, runs, 槽位数, 期望的统计子集)
+        ("空负载", [], 1, {'runs': 0, 'started': 0, 'skipped_busy': 0, 'utilization': 0.0}),
+        ("槽位足够", [(0, 1, 30), (0, 2, 30)], 2,
+         {'started': 2, 'skipped_busy': 0, 'late_runs': 0, 'peak_concurrency': 2}),
+        ("排队未超过等待上限", [(0, 1, 30), (25, 2, 30)], 1,
+         {'started': 2, 'skipped_busy': 0, 'late_runs': 1, 'max_wait': 5.0}),
+        ("排队超过等待上限", [(0, 1, 30), (0, 2, 30)], 1,
+         {'started': 1, 'skipped_busy': 1, 'late_runs': 0}),
+        ("同一目标上次未结束", [(0, 1, 90), (60, 1, 90)], 2,
+         {'started': 1, 'skipped_overlap': 1, 'skipped_busy': 0}),
+        ("利用率按模拟时长截断", [(0, 1, 120)], 1, {'started': 1, 'utilization': 1.0}),
+    ]
+    for name, runs, slots, expected in cases:
+        result = app.simulate_slots(runs, slots, horizon_seconds=60, wait_limit=10)
+        actual = {key: result[key] for key in expected}
+        assert actual == expected, (name, actual)
+
+def test_skipped_busy_monotonic():
+    print("--- 3. skipped_busy 随槽位增加单调不增 ---")
+    loads = [
+        # 同时触发的一批目标
+        [(0, target_id, 40) for target_id in range(8)],
+        # 错开触发、耗时不同的多个周期
+        sorted((cycle * 300 + target_id * 7, target_id, 20 + target_id * 9)
+               for cycle in range(12) for target_id in range(10)),
+        # 周期短于耗时，夹杂同一目标上次未结束的跳过
+        sorted((cycle * 60 + target_id, target_id, 75) for cycle in range(30) for target_id in range(6)),
+    ]
+    for runs in loads:
+        skipped = [app.simulate_slots(runs, slots, 3600)['skipped_busy'] for slots in range(1, 12)]
+        assert all(a >= b for a, b in zip(skipped, skipped[1:])), skipped
+
+def make_target(target_id, **schedule):
+    return app.MonitorTarget(id=target_id, url=f'http://example.com/{target_id}', name=f't{target_id}', **schedule)
+
+def test_plan_capacity_invalid_cron():
+    print("--- 4. 无效的 Cron 表达式不影响其他目标 ---")
+    targets = [
+        make_target(1, schedule_type='interval', interval_minutes=5),
+        make_target(2, schedule_type='cron', cron_schedule='61 * * * *'),
+        make_target(3, schedule_type='cron', cron_schedule='not a cron'),
+    ]
+    # 间隔触发器从创建时刻开始计时，因此从当前时间开始模拟：首次触发在 5 分钟后
+    plan = app.plan_capacity(targets, slots=1, hours=1)
+    assert [row['id'] for row in plan['targets']] == [1]
+    assert len(plan['invalid']) == 2 and plan['invalid'][0].startswith('t2')
+    assert plan['runs_total'] == 11
+
+def test_plan_capacity_truncates_horizon():
+    print("--- 5. 触发次数超限时整体缩短时长 ---")
+    targets = [make_target(target_id, schedule_type='cron', cron_schedule='* * * * *') for target_id in range(1, 4)]
+    limit, app.CAPACITY_MAX_RUNS = app.CAPACITY_MAX_RUNS, 100
+    try:
+        plan = app.plan_capacity(targets, slots=3, hours=24, start=START)
+    finally:
+        app.CAPACITY_MAX_RUNS = limit
+    assert plan['truncated'] and plan['runs_total'] == 99
+    assert plan['simulated_hours'] == 33 / 60
+    # 每个目标在缩短后的时长内都完整计入，而不是只保留排在前面的目标
+    assert sorted(row['runs'] for row in plan['targets']) == [33, 33, 33]
+
+def test_plan_capacity_command_hours_limit():
+    print("--- 6. 命令行模拟时长不超过 CAPACITY_MAX_HOURS ---")
+    runner = app.create_app('cli').test_cli_runner()
+    result = runner.invoke(args=['plan-capacity', '--hours', str(app.CAPACITY_MAX_HOURS + 1)])
+    assert result.exit_code == 2 and '--hours' in result.output, result.output
+
+if __name__ == "__main__":
+    test_expand_fire_times()
+    test_simulate_slots()
+    test_skipped_busy_monotonic()
+    test_plan_capacity_invalid_cron()
+    test_plan_capacity_truncates_horizon()
+    test_plan_capacity_command_hours_limit()